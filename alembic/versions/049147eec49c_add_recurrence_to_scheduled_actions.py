@@ -0,0 +1,28 @@
+"""Add recurrence to scheduled_actions
+
+Revision ID: 049147eec49c
+Revises: 16c73f7e48bf
+Create Date: 2026-10-17 10:41:05.872214
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '049147eec49c'
+down_revision: Union[str, None] = '16c73f7e48bf'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('scheduled_actions', sa.Column('recurrence_rule', sa.Text(), nullable=True))
+    op.add_column('scheduled_actions', sa.Column('timezone', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('scheduled_actions', 'timezone')
+    op.drop_column('scheduled_actions', 'recurrence_rule')
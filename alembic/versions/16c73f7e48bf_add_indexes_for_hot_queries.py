@@ -0,0 +1,39 @@
+"""Add indexes for hot queries
+
+Revision ID: 16c73f7e48bf
+Revises: aecafc39d13f
+Create Date: 2026-10-17 10:03:27.540219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '16c73f7e48bf'
+down_revision: Union[str, None] = 'aecafc39d13f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_scheduled_actions_due', 'scheduled_actions', ['trigger_time'], postgresql_where=sa.text('is_active'))
+    op.create_index('ix_scheduled_actions_user_id_active', 'scheduled_actions', ['user_id'], postgresql_where=sa.text('is_active'))
+    op.create_index('ix_conversations_user_id_timestamp', 'conversations', ['user_id', 'timestamp'])
+    op.create_index('ix_user_action_logs_user_id_timestamp', 'user_action_logs', ['user_id', 'timestamp'])
+    op.create_index('ix_couples_user1_id', 'couples', ['user1_id'])
+    op.create_index('ix_couples_user2_id', 'couples', ['user2_id'])
+    # Hash of the text, long texts exceed the maximum btree entry size
+    op.create_index('ix_translations_original_text_target_language', 'translations', [sa.text('md5(original_text)'), 'target_language'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_translations_original_text_target_language', table_name='translations')
+    op.drop_index('ix_couples_user2_id', table_name='couples')
+    op.drop_index('ix_couples_user1_id', table_name='couples')
+    op.drop_index('ix_user_action_logs_user_id_timestamp', table_name='user_action_logs')
+    op.drop_index('ix_conversations_user_id_timestamp', table_name='conversations')
+    op.drop_index('ix_scheduled_actions_user_id_active', table_name='scheduled_actions')
+    op.drop_index('ix_scheduled_actions_due', table_name='scheduled_actions')
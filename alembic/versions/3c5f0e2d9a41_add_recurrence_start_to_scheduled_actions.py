@@ -0,0 +1,28 @@
+"""Add recurrence_start to scheduled_actions
+
+Revision ID: 3c5f0e2d9a41
+Revises: 7d2e91c4a8b3
+Create Date: 2026-10-17 18:24:12.530861
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c5f0e2d9a41'
+down_revision: Union[str, None] = '7d2e91c4a8b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('scheduled_actions', sa.Column('recurrence_start', sa.DateTime(), nullable=True))
+    # The original start of running series is lost, their rule continues from the current occurrence
+    op.execute('UPDATE scheduled_actions SET recurrence_start = trigger_time WHERE recurrence_rule IS NOT NULL')
+
+
+def downgrade() -> None:
+    op.drop_column('scheduled_actions', 'recurrence_start')
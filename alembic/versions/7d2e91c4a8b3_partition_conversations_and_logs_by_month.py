@@ -0,0 +1,129 @@
+"""Partition conversations and logs by month
+
+Revision ID: 7d2e91c4a8b3
+Revises: fc68c73106a6
+Create Date: 2026-10-17 17:08:51.402715
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d2e91c4a8b3'
+down_revision: Union[str, None] = 'fc68c73106a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Partitions created beyond the current month, retention.py keeps creating them from then on
+MONTHS_AHEAD = 3
+
+# table -> (column definitions without id and timestamp, copied columns, index columns)
+TABLES = {
+    'conversations': (
+        "couple_id BIGINT REFERENCES couples (id), user_id BIGINT REFERENCES users (telegram_id), message TEXT NOT NULL",
+        'couple_id, user_id, message',
+        'user_id, "timestamp"',
+    ),
+    'user_action_logs': (
+        "user_id BIGINT REFERENCES users (telegram_id), action VARCHAR NOT NULL",
+        'user_id, action',
+        'user_id, "timestamp"',
+    ),
+    'translations': (
+        "original_text TEXT NOT NULL, target_language VARCHAR NOT NULL, translated_text TEXT NOT NULL",
+        'original_text, target_language, translated_text',
+        'md5(original_text), target_language',
+    ),
+}
+INDEXES = {
+    'conversations': 'ix_conversations_user_id_timestamp',
+    'user_action_logs': 'ix_user_action_logs_user_id_timestamp',
+    'translations': 'ix_translations_original_text_target_language',
+}
+
+
+def partition_table(table: str) -> None:
+    columns, copied, indexed = TABLES[table]
+    old = f'{table}_unpartitioned'
+    op.execute(f'ALTER TABLE {table} RENAME TO {old}')
+    # Index and primary key names are global, the old ones go with the old table
+    op.execute(f'DROP INDEX {INDEXES[table]}')
+    op.execute(f'ALTER TABLE {old} DROP CONSTRAINT {table}_pkey')
+    # The primary key of a partitioned table has to include the partition key
+    op.execute(f"""
+        CREATE TABLE {table} (
+            id BIGINT NOT NULL DEFAULT nextval('{table}_id_seq'),
+            {columns},
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            PRIMARY KEY (id, "timestamp")
+        ) PARTITION BY RANGE ("timestamp")
+    """)
+    op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+    # One partition per month from the oldest row on, the default partition catches anything outside of them
+    op.execute(f"""
+        DO $$
+        DECLARE month timestamp;
+        BEGIN
+            FOR month IN SELECT generate_series(
+                date_trunc('month', coalesce((SELECT min("timestamp") FROM {old}), now() AT TIME ZONE 'utc')),
+                date_trunc('month', now() AT TIME ZONE 'utc') + interval '{MONTHS_AHEAD} months',
+                interval '1 month'
+            ) LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF {table} FOR VALUES FROM (%L) TO (%L)',
+                               '{table}_' || to_char(month, '"y"YYYY"m"MM'), month, month + interval '1 month');
+            END LOOP;
+        END $$
+    """)
+    op.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+    op.execute(f"""
+        INSERT INTO {table} (id, {copied}, "timestamp")
+        SELECT id, {copied}, coalesce("timestamp", now() AT TIME ZONE 'utc') FROM {old}
+    """)
+    op.execute(f'CREATE INDEX {INDEXES[table]} ON {table} ({indexed})')
+    op.execute(f'DROP TABLE {old}')
+
+
+def unpartition_table(table: str) -> None:
+    columns, copied, indexed = TABLES[table]
+    old = f'{table}_partitioned'
+    op.execute(f'ALTER TABLE {table} RENAME TO {old}')
+    op.execute(f'DROP INDEX {INDEXES[table]}')
+    op.execute(f'ALTER TABLE {old} DROP CONSTRAINT {table}_pkey')
+    op.execute(f"""
+        CREATE TABLE {table} (
+            id BIGINT NOT NULL DEFAULT nextval('{table}_id_seq'),
+            {columns},
+            "timestamp" TIMESTAMP WITHOUT TIME ZONE,
+            CONSTRAINT {table}_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+    op.execute(f'INSERT INTO {table} (id, {copied}, "timestamp") SELECT id, {copied}, "timestamp" FROM {old}')
+    op.execute(f'CREATE INDEX {INDEXES[table]} ON {table} ({indexed})')
+    # Drops the attached partitions, partitions detached by retention.py are left alone
+    op.execute(f'DROP TABLE {old}')
+
+
+def upgrade() -> None:
+    op.create_table('conversation_archives',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('message_count', sa.Integer(), nullable=False),
+    sa.Column('first_message_at', sa.DateTime(), nullable=False),
+    sa.Column('last_message_at', sa.DateTime(), nullable=False),
+    sa.Column('messages', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'month', name='uq_conversation_archives_user_id_month')
+    )
+    for table in TABLES:
+        partition_table(table)
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        unpartition_table(table)
+    op.drop_table('conversation_archives')
@@ -0,0 +1,28 @@
+"""Add prepared message to scheduled_actions
+
+Revision ID: aba313b0b06b
+Revises: 049147eec49c
+Create Date: 2026-10-17 11:20:52.391847
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'aba313b0b06b'
+down_revision: Union[str, None] = '049147eec49c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('scheduled_actions', sa.Column('prepared_message', sa.Text(), nullable=True))
+    op.add_column('scheduled_actions', sa.Column('prepared_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('scheduled_actions', 'prepared_at')
+    op.drop_column('scheduled_actions', 'prepared_message')
@@ -0,0 +1,28 @@
+"""Add lease columns to scheduled_actions
+
+Revision ID: aecafc39d13f
+Revises: 2bf0ab3dec37
+Create Date: 2026-10-17 09:12:41.118302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'aecafc39d13f'
+down_revision: Union[str, None] = '2bf0ab3dec37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('scheduled_actions', sa.Column('claimed_by', sa.String(), nullable=True))
+    op.add_column('scheduled_actions', sa.Column('lease_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('scheduled_actions', 'lease_until')
+    op.drop_column('scheduled_actions', 'claimed_by')
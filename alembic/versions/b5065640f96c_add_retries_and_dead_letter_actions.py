@@ -0,0 +1,47 @@
+"""Add retries to scheduled_actions and dead_letter_actions
+
+Revision ID: b5065640f96c
+Revises: aba313b0b06b
+Create Date: 2026-10-17 13:05:12.604113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5065640f96c'
+down_revision: Union[str, None] = 'aba313b0b06b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('scheduled_actions', sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('scheduled_actions', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+    op.add_column('scheduled_actions', sa.Column('last_error', sa.Text(), nullable=True))
+    op.create_table('dead_letter_actions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('action_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('description', sa.Text(), nullable=False),
+    sa.Column('trigger_time', sa.DateTime(), nullable=False),
+    sa.Column('recurrence_rule', sa.Text(), nullable=True),
+    sa.Column('message', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=False),
+    sa.Column('permanent', sa.Boolean(), nullable=False),
+    sa.Column('failed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_dead_letter_actions_failed_at', 'dead_letter_actions', ['failed_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_dead_letter_actions_failed_at', table_name='dead_letter_actions')
+    op.drop_table('dead_letter_actions')
+    op.drop_column('scheduled_actions', 'last_error')
+    op.drop_column('scheduled_actions', 'next_attempt_at')
+    op.drop_column('scheduled_actions', 'attempts')
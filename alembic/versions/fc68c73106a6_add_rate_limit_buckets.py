@@ -0,0 +1,31 @@
+"""Add rate_limit_buckets
+
+Revision ID: fc68c73106a6
+Revises: b5065640f96c
+Create Date: 2026-10-17 15:42:37.118264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'fc68c73106a6'
+down_revision: Union[str, None] = 'b5065640f96c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('rate_limit_buckets',
+    sa.Column('key', sa.BigInteger(), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('rate_limit_buckets')
@@ -2,14 +2,18 @@ import asyncio
 import structlog
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, ConversationHandler
-from db_utils import  get_session, get_current_user, check_user_linked
+from db_utils import  get_async_session, get_current_user, check_user_linked, load_user_context
 from tools import build_call_tool_function, get_llm_functions
-from utils import get_translated_message, send_message_to_user, rate_limited, update_user_language
-from models import User, Couple, PendingCouple, Conversation, ScheduledAction
+from utils import fill_template, get_translated_message, reply_text, send_message_to_user, rate_limited, stream_reply, update_user_language
+from models import User, Couple, PendingCouple, Conversation, ConversationArchive, ScheduledAction
 from scheduler import start_scheduler
-from database import init_db
+from retention import start_retention
+from database import async_engine, init_db
+from outbox import outbox
+import write_behind
 from llm import LLMWrapper, get_user_summary, prepare_context_messages, save_conversation, setup_llm
 import secrets
+from sqlalchemy import delete, select
 from sqlalchemy.exc import SQLAlchemyError
 from settings import settings
 
@@ -27,66 +31,61 @@ CONFIRM_UNLINK, CONFIRM_DELETE = range(2)
 
 async def link_users_and_notify(session, context, couple, current_user, requester):
     session.add(couple)
-    session.commit()
+    await session.commit()
 
     # Get the language preferences for both users, defaulting to 'en' if not set
     requester_language = requester.language or 'en'
     current_user_language = current_user.language or 'en'
 
+    # Translate the notification for both users at once
+    notifications = await llm.translations.translate_many_languages(["You are now linked with {partner_name}!"], [requester_language, current_user_language])
+
     # Notify requester
-    requester_message = get_translated_message(
-        llm,
-        f"You are now linked with {current_user.name}!",
-        requester_language
-    )
-    await context.bot.send_message(chat_id=requester.telegram_id, text=requester_message)
+    requester_message = fill_template("You are now linked with {partner_name}!", notifications[requester_language][0], partner_name=current_user.name)
+    await outbox.submit(requester.telegram_id, lambda: context.bot.send_message(chat_id=requester.telegram_id, text=requester_message))
 
     # Notify current user
-    current_user_message = get_translated_message(
-        llm,
-        f"You are now linked with {requester.name}!",
-        current_user_language
-    )
-    await context.bot.send_message(chat_id=current_user.telegram_id, text=current_user_message)
+    current_user_message = fill_template("You are now linked with {partner_name}!", notifications[current_user_language][0], partner_name=requester.name)
+    await outbox.submit(current_user.telegram_id, lambda: context.bot.send_message(chat_id=current_user.telegram_id, text=current_user_message))
 
     # Log the successful linking of the couple
     logger.info("Couple linked successfully", couple_id=couple.id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
+    async with get_async_session() as session:
         token = context.args[0] if context.args else None
         telegram_user_language = update.message.from_user.language_code or 'en'
 
         logger.info("User started bot", telegram_id=update.effective_user.id)
 
-        current_user = get_current_user(session, update.effective_user.id)
+        current_user = await get_current_user(session, update.effective_user.id)
         if not current_user:
             current_user = User(telegram_id=update.effective_user.id, name=update.effective_user.full_name, language=telegram_user_language)
             session.add(current_user)
-            session.commit()
+            await session.commit()
             logger.info("New user registered", telegram_id=update.effective_user.id)
         else:
             # Update the user's language if it has changed
-            update_user_language(session, current_user, telegram_user_language)
+            await update_user_language(session, current_user, telegram_user_language)
 
         if token:
-            pending_couple = session.query(PendingCouple).filter(PendingCouple.token == token).first()
+            pending_couple = await session.scalar(select(PendingCouple).where(PendingCouple.token == token))
 
             if pending_couple:
                 if pending_couple.requested_id is None:
                     # Check if the current user is trying to link with themselves
                     if pending_couple.requester_id == current_user.telegram_id:
-                        translated_message = get_translated_message(llm, "You cannot link with yourself.", telegram_user_language)
-                        await update.message.reply_text(translated_message)
+                        translated_message = await get_translated_message(llm, "You cannot link with yourself.", telegram_user_language)
+                        await reply_text(update.message, translated_message)
                         logger.warning("User attempted to link with themselves", telegram_id=update.effective_user.id)
                         return
 
                     pending_couple.requested_id = current_user.telegram_id
 
-                    requester = session.query(User).filter(User.telegram_id == pending_couple.requester_id).first()
+                    requester = await session.scalar(select(User).where(User.telegram_id == pending_couple.requester_id))
                     if not requester:
-                        translated_message = get_translated_message(llm, "Error: Requester not found.", telegram_user_language)
-                        await update.message.reply_text(translated_message)
+                        translated_message = await get_translated_message(llm, "Error: Requester not found.", telegram_user_language)
+                        await reply_text(update.message, translated_message)
                         logger.error("Requester not found", requester_id=pending_couple.requester_id)
                         return
 
@@ -95,7 +94,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         user2_id=pending_couple.requested_id
                     )
 
-                    session.delete(pending_couple)
+                    await session.delete(pending_couple)
 
                     await link_users_and_notify(session, context, couple, current_user, requester)
                 elif pending_couple.requested_id == current_user.telegram_id:
@@ -105,27 +104,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                     session.add(couple)
 
-                    session.delete(pending_couple)
+                    await session.delete(pending_couple)
 
                     await link_users_and_notify(session, context, couple, current_user, requester)
                 else:
-                    translated_message = get_translated_message(llm, "This link is not meant for you.", telegram_user_language)
-                    await update.message.reply_text(translated_message)
+                    translated_message = await get_translated_message(llm, "This link is not meant for you.", telegram_user_language)
+                    await reply_text(update.message, translated_message)
                     logger.warning("Invalid link attempt", telegram_id=update.effective_user.id)
             else:
-                translated_message = get_translated_message(llm, "Invalid or expired link.", telegram_user_language)
-                await update.message.reply_text(translated_message)
+                translated_message = await get_translated_message(llm, "Invalid or expired link.", telegram_user_language)
+                await reply_text(update.message, translated_message)
                 logger.warning("Expired or invalid link used", telegram_id=update.effective_user.id)
         else:
-            translated_message = get_translated_message(llm, f"Hello {update.effective_user.full_name}! Welcome to ThirdWheeler.", telegram_user_language)
-            await update.message.reply_text(translated_message)
+            translated_message = await get_translated_message(llm, "Hello {name}! Welcome to ThirdWheeler.", telegram_user_language, name=update.effective_user.full_name)
+            await reply_text(update.message, translated_message)
 
 async def add_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        if await rate_limited(update, context, session, llm):
+    async with get_async_session() as session:
+        user_context = await load_user_context(session, update.effective_user.id)
+        if await rate_limited(update, context, llm, user_context):
             return
         
-        user = get_current_user(session, update.effective_user.id)
+        user = await get_current_user(session, update.effective_user.id)
         user_language = update.message.from_user.language_code or 'en'
 
         if not user:
@@ -134,9 +134,9 @@ async def add_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Update the user's language if it has changed
-        update_user_language(session, user, user_language)
+        await update_user_language(session, user, user_language)
 
-        existing_couple = check_user_linked(session, user.telegram_id)
+        existing_couple = await check_user_linked(session, user.telegram_id)
 
         if existing_couple:
             await send_message_to_user(context.bot, update.effective_user.id, "You are already linked with a partner. Remove that link first with /remove_partner", llm, user_language)
@@ -152,21 +152,22 @@ async def add_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session.add(pending_couple)
 
         invite_link = f"https://t.me/{context.bot.username}?start={token}"
-        await send_message_to_user(context.bot, update.effective_user.id, f"Here is your invite link: {invite_link}\nShare this with your partner to link your chats.", llm, user_language)
+        await send_message_to_user(context.bot, update.effective_user.id, "Here is your invite link: {invite_link}\nShare this with your partner to link your chats.", llm, user_language, invite_link=invite_link)
         logger.info("Invite link generated", user_id=user.telegram_id, invite_link=invite_link)
 
 async def remove_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        if await rate_limited(update, context, session, llm):
+    async with get_async_session() as session:
+        user_context = await load_user_context(session, update.effective_user.id)
+        if await rate_limited(update, context, llm, user_context):
             return
         
-        user = get_current_user(session, update.effective_user.id)
+        user = await get_current_user(session, update.effective_user.id)
         user_language = update.message.from_user.language_code or 'en'
 
         # Update the user's language if it has changed
-        update_user_language(session, user, user_language)
+        await update_user_language(session, user, user_language)
 
-        couple = check_user_linked(session, user.telegram_id)
+        couple = await check_user_linked(session, user.telegram_id)
 
         if not couple:
             await send_message_to_user(context.bot, update.effective_user.id, "You are not linked with any partner.", llm, user_language)
@@ -177,16 +178,16 @@ async def remove_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return CONFIRM_UNLINK
 
 async def confirm_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        user = get_current_user(session, update.effective_user.id)
+    async with get_async_session() as session:
+        user = await get_current_user(session, update.effective_user.id)
         user_language = update.message.from_user.language_code or 'en'
 
         try:
             if update.message.text.lower() == 'yes':
-                couple = check_user_linked(session, user.telegram_id)
+                couple = await check_user_linked(session, user.telegram_id)
 
                 if couple:
-                    session.delete(couple)
+                    await session.delete(couple)
                     await send_message_to_user(context.bot, update.effective_user.id, "You have been unlinked from your partner.", llm, user_language)
                     logger.info("Partner unlinked successfully", user_id=user.telegram_id, partner_id=(couple.user1_id if couple.user2_id == user.telegram_id else couple.user2_id))
                 else:
@@ -202,21 +203,22 @@ async def confirm_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def delete_all_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        if await rate_limited(update, context, session, llm):
+    async with get_async_session() as session:
+        user_context = await load_user_context(session, update.effective_user.id)
+        if await rate_limited(update, context, llm, user_context):
             return
         
-        user = get_current_user(session, update.effective_user.id)
+        user = await get_current_user(session, update.effective_user.id)
         user_language = update.message.from_user.language_code or 'en'
 
         # Update the user's language if it has changed
-        update_user_language(session, user, user_language)
+        await update_user_language(session, user, user_language)
 
-        couple = check_user_linked(session, user.telegram_id)
+        couple = await check_user_linked(session, user.telegram_id)
 
         if not couple:
             await send_message_to_user(context.bot, update.effective_user.id, "You are not linked with any partner. Your data will be deleted.", llm, user_language)
-            session.delete(user)
+            await session.delete(user)
             logger.info("User data deleted (no partner linked)", telegram_id=update.effective_user.id)
             return ConversationHandler.END
 
@@ -224,25 +226,26 @@ async def delete_all_my_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return CONFIRM_DELETE
 
 async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        user = get_current_user(session, update.effective_user.id)
+    async with get_async_session() as session:
+        user = await get_current_user(session, update.effective_user.id)
         user_language = update.message.from_user.language_code or 'en'
 
         try:
             if update.message.text.lower() == 'yes':
-                couple = check_user_linked(session, user.telegram_id)
+                couple = await check_user_linked(session, user.telegram_id)
 
                 if couple:
                     partner_id = couple.user1_id if couple.user2_id == user.telegram_id else couple.user2_id
-                    partner = get_current_user(session, partner_id)
+                    partner = await get_current_user(session, partner_id)
 
-                    session.query(Conversation).filter(Conversation.couple_id == couple.id).delete()
-                    session.query(ScheduledAction).filter(ScheduledAction.couple_id == couple.id).delete()
+                    await session.execute(delete(Conversation).where(Conversation.couple_id == couple.id))
+                    await session.execute(delete(ScheduledAction).where(ScheduledAction.couple_id == couple.id))
+                    await session.execute(delete(ConversationArchive).where(ConversationArchive.user_id.in_([user.telegram_id, partner_id])))
 
-                    session.delete(couple)
-                    session.delete(user)
+                    await session.delete(couple)
+                    await session.delete(user)
                     if partner:
-                        session.delete(partner)
+                        await session.delete(partner)
 
                     await send_message_to_user(context.bot, update.effective_user.id, "All your data and your partner's data have been deleted.", llm, user_language)
                     logger.info("User and partner data deleted successfully", user_id=user.telegram_id, partner_id=partner_id)
@@ -260,74 +263,78 @@ async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_language = update.message.from_user.language_code or 'en'
-    translated_message = get_translated_message(llm, "Unlinking process has been cancelled.", user_language)
-    await update.message.reply_text(translated_message)
+    translated_message = await get_translated_message(llm, "Unlinking process has been cancelled.", user_language)
+    await reply_text(update.message, translated_message)
     logger.info("Unlinking process cancelled", telegram_id=update.effective_user.id)
     return ConversationHandler.END
 
 async def cancel_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_language = update.message.from_user.language_code or 'en'
-    translated_message = get_translated_message(llm, "Data deletion process has been cancelled.", user_language)
-    await update.message.reply_text(translated_message)
+    translated_message = await get_translated_message(llm, "Data deletion process has been cancelled.", user_language)
+    await reply_text(update.message, translated_message)
     logger.info("Data deletion process cancelled", telegram_id=update.effective_user.id)
     return ConversationHandler.END
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        if await rate_limited(update, context, session, llm):
+    async with get_async_session() as session:
+        # Everything needed about the user in one query
+        user = await load_user_context(session, update.effective_user.id)
+        if await rate_limited(update, context, llm, user):
             return
 
         user_telegram_id = update.effective_user.id
         message = update.message.text
-
-        user = get_current_user(session, user_telegram_id)
         user_language = update.message.from_user.language_code or 'en'
 
-        if not user:
-            await send_message_to_user(context.bot, user_telegram_id, "Please start the bot first using /start.", llm, user_language)
-            logger.warning("User attempted to send a message without starting the bot", telegram_id=update.effective_user.id)
-            return
-
         # Update the user's language if it has changed
-        update_user_language(session, user, user_language)
+        await update_user_language(session, user, user_language)
 
-        user_summary = get_user_summary(user)
-        context_messages = prepare_context_messages(session, user, user_summary, message)
+        budget = llm.context_budget()
+        user_summary = budget.fit_summary(get_user_summary(user))
+        context_messages = prepare_context_messages(user, user_summary, message, budget)
+        await session.commit()  # Return the connection to the pool while the reply is generated
 
         logger.info("Handling user message", telegram_id=user_telegram_id, message=message)
 
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-        response = await llm.get_response(
+        await stream_reply(update.message, llm.stream_response(
             context_messages, 
             summary=user_summary, 
             user_language=user_language, 
             tools=get_llm_functions(),
-            call_tool=build_call_tool_function(context.bot, session, llm, user, user_language)
-        )
-
-        response_content = response.content
-        await update.message.reply_text(response_content)
+            call_tool=build_call_tool_function(context.bot, llm, user, user_language)
+        ))
 
-        await save_conversation(session, user.telegram_id, message)
+        await save_conversation(user.telegram_id, message)
 
         logger.info("User message handled successfully", telegram_id=user_telegram_id)
 
 
-import threading
+async def post_init(application):
+    await llm.translations.preload()
+    # The scheduler runs on the application's loop and shares its Bot and the LLM client
+    application.bot_data["scheduler"] = await start_scheduler(application.bot, llm)
+    application.bot_data["retention"] = await start_retention()
 
-def main():
-    init_db()
+async def post_stop(application):
+    for name in ("scheduler", "retention"):
+        task = application.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
 
-    # Start the scheduler in a separate thread
-    # scheduler_thread = threading.Thread(target=start_scheduler, args=(settings.BOT_TOKEN,), daemon=True)
-    # scheduler_thread.start()
+async def post_shutdown(application):
+    await outbox.close()
+    await write_behind.close()
+    await llm.aclose()
+    await async_engine.dispose()
 
-    scheduler_thread = threading.Thread(target=lambda: asyncio.run(start_scheduler(settings.BOT_TOKEN)), daemon=True)
-    scheduler_thread.start()
+def main():
+    init_db()
 
-    application = ApplicationBuilder().token(settings.BOT_TOKEN).build()
+    application = ApplicationBuilder().token(settings.BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("add_partner", add_partner))
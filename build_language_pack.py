@@ -0,0 +1,89 @@
+"""Build the language pack with the translations of all fixed system messages.
+
+Extracts the message templates passed to get_translated_message / send_message_to_user / fill_template,
+translates them in batches for the configured languages and writes them to settings.language_pack_path.
+The bot loads the pack at startup and only translates live for languages not in the pack.
+
+usage: python build_language_pack.py [--languages de fr ...] [--output language_pack.json]
+"""
+import argparse
+import ast
+import asyncio
+import json
+import os
+import structlog
+from llm import setup_llm
+from settings import settings
+from utils import template_fields
+
+logger = structlog.get_logger()
+
+SOURCE_FILES = ["bot.py", "utils.py", "tools.py"]
+
+# Translatable functions and the position / keyword of their message argument
+TRANSLATABLE_CALLS = {
+    "get_translated_message": (1, "text"),
+    "send_message_to_user": (2, "message"),
+    "fill_template": (0, "template"),
+}
+
+def extract_messages(paths: list[str]) -> list[str]:
+    """Return all string literals passed as message to a translatable function."""
+    messages = set()
+    for path in paths:
+        with open(path) as f:
+            tree = ast.parse(f.read(), filename=path)
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call):
+                continue
+            name = node.func.id if isinstance(node.func, ast.Name) else getattr(node.func, "attr", None)
+            if name not in TRANSLATABLE_CALLS:
+                continue
+            position, keyword = TRANSLATABLE_CALLS[name]
+            arg = node.args[position] if len(node.args) > position else next((kw.value for kw in node.keywords if kw.arg == keyword), None)
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                messages.add(arg.value)
+            elif arg is not None and not isinstance(arg, ast.Name):  # Names are forwarded templates
+                logger.warning("Skipping non-literal message", path=path, line=node.lineno)
+    return sorted(messages)
+
+async def translate_language(llm, messages: list[str], language: str) -> dict[str, str]:
+    translations = {}
+    for start in range(0, len(messages), settings.language_pack_batch_size):
+        batch = messages[start:start + settings.language_pack_batch_size]
+        results = await llm.translations.translate_many(batch, language)
+        for message, translated in zip(batch, results):
+            # Leave out failed or broken translations, they are translated live instead
+            try:
+                fields = template_fields(translated)
+            except ValueError:  # Unbalanced braces
+                fields = None
+            if translated == message or fields != template_fields(message):
+                logger.warning("No usable translation", message=message, language=language)
+                continue
+            translations[message] = translated
+    return translations
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--languages", nargs="+", default=settings.language_pack_languages)
+    parser.add_argument("--output", default=settings.language_pack_path)
+    args = parser.parse_args()
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    messages = extract_messages([os.path.join(base_dir, path) for path in SOURCE_FILES])
+    logger.info("Extracted system messages", count=len(messages))
+
+    llm = setup_llm()
+    languages = {}
+    for language in args.languages:
+        languages[language] = await translate_language(llm, messages, language)
+        logger.info("Language translated", language=language, translated=len(languages[language]), total=len(messages))
+    await llm.aclose()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"languages": languages}, f, ensure_ascii=False, separators=(",", ":"))
+    logger.info("Language pack written", path=args.output, languages=list(languages))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+"""Check that the hot queries are served by their indexes.
+
+Seeds realistic volumes into the configured Postgres database inside a transaction,
+runs EXPLAIN on each hot query and fails if a table is scanned sequentially instead of
+through the expected index. Partitions count as their partitioned table and their indexes
+as the partitioned index. Tables and partitions with fewer than SMALL_TABLE_ROWS rows (e.g.
+couples with the default --users, the partitions of the coming months) are read sequentially
+whatever their indexes and are left out. Everything is rolled back at the end.
+
+usage: python check_query_plans.py [--users 2000]
+"""
+import argparse
+import sys
+from sqlalchemy import text
+from database import engine
+
+# Offset for the seeded ids so they don't collide with existing rows
+SEED_OFFSET = 10**15
+# Relations the planner may scan sequentially, an index doesn't pay off below this size
+SMALL_TABLE_ROWS = 10000
+
+SEED_STATEMENTS = [
+    """INSERT INTO users (telegram_id, name, language)
+       SELECT :offset + u, 'user ' || u, 'de' FROM generate_series(1, :users) u""",
+    """INSERT INTO couples (user1_id, user2_id)
+       SELECT :offset + u, :offset + u + 1 FROM generate_series(1, :users - 1, 2) u""",
+    """INSERT INTO conversations (user_id, message, timestamp)
+       SELECT :offset + u, 'message ' || c, now() - c * interval '1 hour'
+       FROM generate_series(1, :users) u, generate_series(1, 50) c""",
+    """INSERT INTO user_action_logs (user_id, action, timestamp)
+       SELECT :offset + u, 'message', now() - c * interval '1 hour'
+       FROM generate_series(1, :users) u, generate_series(1, 50) c""",
+    # Most actions were triggered long ago, a few are active and upcoming
+    """INSERT INTO scheduled_actions (user_id, description, trigger_time, is_active)
+       SELECT :offset + u, 'reminder ' || a, now() + (a - 18) * interval '1 day', a > 18
+       FROM generate_series(1, :users) u, generate_series(1, 20) a""",
+    """INSERT INTO translations (original_text, target_language, translated_text, timestamp)
+       SELECT 'system message ' || m, l, 'translation ' || m, now()
+       FROM generate_series(1, :users) m, unnest(ARRAY['de', 'fr', 'es', 'it', 'pl']) l""",
+]
+
+# (description, query, table, expected index)
+HOT_QUERIES = [
+    ("scheduler due scan",
+     "SELECT id, user_id, trigger_time, lease_until FROM scheduled_actions WHERE trigger_time <= now() + interval '5 minutes' AND is_active",
+     "scheduled_actions", "ix_scheduled_actions_due"),
+    ("active actions of a user",
+     "SELECT * FROM scheduled_actions WHERE user_id = :user_id AND is_active",
+     "scheduled_actions", "ix_scheduled_actions_user_id_active"),
+    ("conversation count of a user",
+     "SELECT count(*) FROM conversations WHERE user_id = :user_id",
+     "conversations", "ix_conversations_user_id_timestamp"),
+    ("recent conversations of a user",
+     "SELECT * FROM conversations WHERE user_id = :user_id ORDER BY timestamp DESC LIMIT 5",
+     "conversations", "ix_conversations_user_id_timestamp"),
+    ("latest action log of a user",
+     "SELECT timestamp FROM user_action_logs WHERE user_id = :user_id ORDER BY timestamp DESC LIMIT 1",
+     "user_action_logs", "ix_user_action_logs_user_id_timestamp"),
+    ("couple of a user",
+     "SELECT * FROM couples WHERE user1_id = :user_id OR user2_id = :user_id LIMIT 1",
+     "couples", None),  # BitmapOr over both user indexes
+    ("translation lookup",
+     "SELECT translated_text FROM translations WHERE md5(original_text) = md5('system message 42') AND original_text = 'system message 42' AND target_language = 'fr' LIMIT 1",
+     "translations", "ix_translations_original_text_target_language"),
+]
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+# Partitions and their indexes, mapped to the partitioned table and index they belong to
+PARENTS = """
+    SELECT child.relname, parent.relname FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+"""
+
+# Estimated rows of the tables and partitions, as of the last ANALYZE
+ROWS = "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"
+
+def check_plan(plan: dict, table: str, expected_index: str | None, parents: dict[str, str], rows: dict[str, float]) -> list[str]:
+    problems = []
+    nodes = list(plan_nodes(plan))
+    for node in nodes:
+        relation = node.get("Relation Name")
+        if node["Node Type"] == "Seq Scan" and parents.get(relation, relation) == table and rows.get(relation, SMALL_TABLE_ROWS) >= SMALL_TABLE_ROWS:
+            problems.append(f"sequential scan on {node['Relation Name']}")
+    if sum(count for relation, count in rows.items() if parents.get(relation, relation) == table) < SMALL_TABLE_ROWS:
+        return problems  # A small table doesn't need its indexes
+    used_indexes = {parents.get(node["Index Name"], node["Index Name"]) for node in nodes if "Index Name" in node}
+    if expected_index and expected_index not in used_indexes:
+        problems.append(f"expected index {expected_index}, used {sorted(used_indexes) or 'none'}")
+    if not used_indexes:
+        problems.append(f"no index used on {table}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+
+    failures = 0
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for statement in SEED_STATEMENTS:
+                connection.execute(text(statement), {"offset": SEED_OFFSET, "users": args.users})
+            for table in ("users", "couples", "conversations", "user_action_logs", "scheduled_actions", "translations"):
+                connection.execute(text(f"ANALYZE {table}"))
+            parents = dict(connection.execute(text(PARENTS)).all())
+            rows = dict(connection.execute(text(ROWS)).all())
+
+            for description, query, table, expected_index in HOT_QUERIES:
+                plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), {"user_id": SEED_OFFSET + 42}).scalar()[0]["Plan"]
+                problems = check_plan(plan, table, expected_index, parents, rows)
+                status = "FAIL" if problems else "ok"
+                print(f"[{status}] {description}" + "".join(f"\n       {problem}" for problem in problems))
+                failures += bool(problems)
+        finally:
+            transaction.rollback()
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
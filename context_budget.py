@@ -0,0 +1,141 @@
+from datetime import datetime, timezone
+from functools import lru_cache
+import structlog
+from models import ScheduledAction
+from settings import settings
+from utils import format_scheduled_action
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to estimating the token count from the text length
+    tiktoken = None
+
+logger = structlog.get_logger()
+
+# Tokens the chat format adds per message on top of its content
+MESSAGE_OVERHEAD = 4
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Not an OpenAI model (e.g. llama3.1), cl100k_base is a close enough approximation
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # e.g. offline, the encoding can't be downloaded
+        logger.warning("Tokenizer unavailable, estimating token counts", model_name=model_name, error=str(e))
+        return None
+
+def count_tokens(text: str, model_name: str) -> int:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text: str, max_tokens: int, model_name: str) -> str:
+    """Cut a text down to max_tokens, keeping its beginning."""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+class ContextBudget:
+    """Keeps the prompt of one request within the model's context limit.
+
+    Sections are filled in priority order: the static prompt and the current message
+    are always included, the summary, the archived conversations and the scheduled actions
+    may use up to their share of the limit, the conversation history gets what is left and
+    is trimmed first."""
+
+    def __init__(self, model_name: str, fixed: list[str]):
+        self.model_name = model_name
+        self.limit = settings.llm_context_limits.get(model_name, settings.llm_context_limit_default) - settings.llm_completion_reserve
+        self.used = 0
+        for text in fixed:
+            self.reserve(text)
+
+    @property
+    def remaining(self) -> int:
+        return max(self.limit - self.used, 0)
+
+    def _section_budget(self, share: float) -> int:
+        return min(int(self.limit * share), self.remaining)
+
+    def reserve(self, text: str | None) -> int:
+        """Account for content that is always included."""
+        if not text:
+            return 0
+        tokens = count_tokens(text, self.model_name) + MESSAGE_OVERHEAD
+        self.used += tokens
+        return tokens
+
+    def fit_summary(self, summary: str) -> str:
+        if not summary:
+            return summary
+        budget = self._section_budget(settings.context_summary_share)
+        if count_tokens(summary, self.model_name) > budget:
+            logger.info("Summary trimmed to budget", budget=budget)
+            summary = truncate_to_tokens(summary, budget - 1, self.model_name) + "…"
+        self.reserve(summary)
+        return summary
+
+    def fit_archive(self, archive: str) -> str:
+        """Fit the archived conversations, dropping their oldest messages first."""
+        if not archive:
+            return archive
+        budget = self._section_budget(settings.context_archive_share)
+        header, *lines = archive.split("\n")
+        total = len(lines)
+        while lines and count_tokens("\n".join([header, *lines]), self.model_name) > budget:
+            lines.pop(0)
+        if len(lines) < total:
+            logger.info("Archive trimmed to budget", kept=len(lines), total=total, budget=budget)
+        if not lines:
+            return ""
+        archive = "\n".join([header, *lines])
+        self.reserve(archive)
+        return archive
+
+    def format_actions(self, actions: list[ScheduledAction]) -> str:
+        """Format the scheduled actions, soonest first, leaving out those beyond the budget."""
+        if not actions:
+            formatted = "No scheduled actions."
+            self.reserve(formatted)
+            return formatted
+
+        budget = self._section_budget(settings.context_actions_share)
+        current_time = datetime.now(timezone.utc)
+        formatted = "Here are the scheduled actions:\n"
+        used = count_tokens(formatted, self.model_name) + MESSAGE_OVERHEAD
+        shown = 0
+        for action in sorted(actions, key=lambda action: action.trigger_time):
+            line = format_scheduled_action(action, current_time)
+            tokens = count_tokens(line, self.model_name)
+            if used + tokens > budget:
+                break
+            formatted += line
+            used += tokens
+            shown += 1
+        if shown < len(actions):
+            formatted += f"({len(actions) - shown} later actions not shown)\n"
+            logger.info("Scheduled actions trimmed to budget", shown=shown, total=len(actions), budget=budget)
+        self.reserve(formatted)
+        return formatted
+
+    def fit_history(self, messages: list[dict]) -> list[dict]:
+        """Keep the most recent messages that fit into the remaining budget."""
+        kept = []
+        for message in reversed(messages):
+            tokens = count_tokens(message["content"], self.model_name) + MESSAGE_OVERHEAD
+            if tokens > self.remaining:
+                break
+            self.used += tokens
+            kept.append(message)
+        if len(kept) < len(messages):
+            logger.info("History trimmed to budget", kept=len(kept), total=len(messages))
+        return list(reversed(kept))
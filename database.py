@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine
+import time
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from models import Base
 from settings import settings
@@ -16,6 +19,64 @@ engine = create_engine(db_url)
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine over asyncpg for the bot and the scheduler, the sync engine is left to scripts and migrations
+async_db_url = db_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+async_engine = create_async_engine(
+    async_db_url,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=True
+)
+def encode_timestamp(value: datetime) -> str:
+    return (value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value).isoformat()
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    # The DateTime columns hold naive UTC times, unlike psycopg2 asyncpg rejects the aware datetimes they are compared with
+    dbapi_connection.run_async(lambda connection: connection.set_type_codec(
+        "timestamp", schema="pg_catalog", format="text", encoder=encode_timestamp, decoder=datetime.fromisoformat
+    ))
+
+# Objects stay usable after commit, they are read again in the same handler
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Wait: time a session waited for a connection, held: time a connection was checked out
+pool_metrics = {"checkouts": 0, "wait_total": 0.0, "wait_max": 0.0, "checkins": 0, "held_total": 0.0, "held_max": 0.0}
+
+@event.listens_for(async_engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["checked_out_at"] = time.monotonic()
+
+@event.listens_for(async_engine.sync_engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    checked_out_at = connection_record.info.pop("checked_out_at", None)
+    if checked_out_at is not None:
+        held = time.monotonic() - checked_out_at
+        pool_metrics["checkins"] += 1
+        pool_metrics["held_total"] += held
+        pool_metrics["held_max"] = max(pool_metrics["held_max"], held)
+
+def record_pool_wait(waited: float):
+    pool_metrics["checkouts"] += 1
+    pool_metrics["wait_total"] += waited
+    pool_metrics["wait_max"] = max(pool_metrics["wait_max"], waited)
+
+def pool_stats() -> dict:
+    pool = async_engine.pool
+    checkouts, checkins = pool_metrics["checkouts"], pool_metrics["checkins"]
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": checkouts,
+        "wait_avg": pool_metrics["wait_total"] / checkouts if checkouts else 0.0,
+        "wait_max": pool_metrics["wait_max"],
+        "held_avg": pool_metrics["held_total"] / checkins if checkins else 0.0,
+        "held_max": pool_metrics["held_max"],
+    }
+
 def init_db():
     # Create all tables in the database
     Base.metadata.create_all(bind=engine)
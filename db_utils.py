@@ -1,14 +1,22 @@
 # db_utils.py
+import time
+from dataclasses import dataclass
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
 from sqlalchemy.orm import Session
-from contextlib import contextmanager
-from database import SessionLocal
-from models import User, Couple
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager, contextmanager
+from database import AsyncSessionLocal, SessionLocal, record_pool_wait
+from models import Conversation, ConversationArchive, User, Couple
+from sqlalchemy import exists, func, literal_column, or_, select, text, true, update
 from sqlalchemy.exc import SQLAlchemyError
-from models import ScheduledAction
+from models import DeadLetterAction, ScheduledAction
 from sqlalchemy.orm import Session
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from dateutil import parser
 
+# Postgres NOTIFY channel, the scheduler wakes up when the schedule changes
+SCHEDULE_CHANNEL = "scheduled_actions_changed"
+
 @contextmanager
 def get_session() -> Session:
     session: Session = SessionLocal()
@@ -21,21 +29,91 @@ def get_session() -> Session:
     finally:
         session.close()
 
-def get_current_user(session: Session, telegram_id: int) -> User:
-    return session.query(User).filter(User.telegram_id == telegram_id).first()
+@asynccontextmanager
+async def get_async_session() -> AsyncSession:
+    async with AsyncSessionLocal() as session:
+        started = time.monotonic()
+        await session.connection()
+        record_pool_wait(time.monotonic() - started)
+        try:
+            yield session
+            await session.commit()
+        except SQLAlchemyError as e:
+            await session.rollback()
+            raise e
+
+async def get_current_user(session: AsyncSession, telegram_id: int) -> User:
+    return await session.scalar(select(User).where(User.telegram_id == telegram_id))
 
-def check_user_linked(session: Session, user_id: int) -> Couple:
-    return session.query(Couple).filter(
+async def check_user_linked(session: AsyncSession, user_id: int) -> Couple:
+    return await session.scalar(select(Couple).where(
         (Couple.user1_id == user_id) | (Couple.user2_id == user_id)
-    ).first()
+    ).limit(1))
 
-def get_scheduled_actions_for_user(session: Session, user_id: int):
-    return session.query(ScheduledAction).filter(
+async def get_scheduled_actions_for_user(session: AsyncSession, user_id: int):
+    return (await session.scalars(select(ScheduledAction).where(
         ScheduledAction.user_id == user_id,
         ScheduledAction.is_active == True
-    ).all()
+    ))).all()
+
+@dataclass(frozen=True)
+class ActionSnapshot:
+    id: int
+    description: str
+    trigger_time: datetime
+
+@dataclass(frozen=True)
+class UserContext:
+    """Read-only snapshot of everything a message handler needs about a user, see load_user_context."""
+    telegram_id: int
+    name: str
+    language: str | None
+    summary: str | None
+    couple_id: int | None
+    actions: tuple[ActionSnapshot, ...]  # Active scheduled actions, soonest first
+    has_history: bool  # False on the first interaction
+    archive: str | None  # Compacted messages of the latest archived month, see retention.py
+
+async def load_user_context(session: AsyncSession, telegram_id: int) -> UserContext | None:
+    """Load a user with their couple, active actions, latest archive and whether they have a history in a single query."""
+    actions = select(func.coalesce(
+        func.json_agg(aggregate_order_by(
+            func.json_build_object('id', ScheduledAction.id, 'description', ScheduledAction.description, 'trigger_time', ScheduledAction.trigger_time),
+            ScheduledAction.trigger_time
+        )),
+        literal_column("'[]'::json"),
+        type_=JSON
+    )).where(ScheduledAction.user_id == User.telegram_id, ScheduledAction.is_active == True).scalar_subquery()
+    archive = select(ConversationArchive.month, ConversationArchive.messages).where(
+        ConversationArchive.user_id == User.telegram_id
+    ).order_by(ConversationArchive.month.desc()).limit(1).lateral()
+    has_history = or_(exists().where(Conversation.user_id == User.telegram_id), archive.c.month.is_not(None))
+
+    row = (await session.execute(
+        select(User.telegram_id, User.name, User.language, User.summary, Couple.id,
+               actions, has_history, archive.c.month, archive.c.messages)
+        .select_from(User)
+        .outerjoin(Couple, or_(Couple.user1_id == User.telegram_id, Couple.user2_id == User.telegram_id))
+        .outerjoin(archive, true())
+        .where(User.telegram_id == telegram_id)
+        .limit(1)
+    )).first()
+    if row is None:
+        return None
 
-def add_scheduled_action(session: Session, user_id: int, description: str, trigger_time: datetime):
+    telegram_id, name, language, summary, couple_id, actions, has_history, archive_month, archive_messages = row
+    return UserContext(
+        telegram_id=telegram_id,
+        name=name,
+        language=language,
+        summary=summary,
+        couple_id=couple_id,
+        actions=tuple(ActionSnapshot(action['id'], action['description'], datetime.fromisoformat(action['trigger_time'])) for action in actions),
+        has_history=has_history,
+        archive=f"{archive_month:%B %Y}:\n{archive_messages}" if archive_month else None
+    )
+
+async def add_scheduled_action(session: AsyncSession, user_id: int, description: str, trigger_time: datetime, recurrence_rule: str = None, timezone_name: str = None):
     # Parse the trigger_time string into a datetime object
     # trigger_time_dt = parser.parse(trigger_time)
     
@@ -43,14 +121,97 @@ def add_scheduled_action(session: Session, user_id: int, description: str, trigg
         user_id=user_id,
         description=description,
         trigger_time=trigger_time,
+        recurrence_rule=recurrence_rule,
+        recurrence_start=trigger_time if recurrence_rule else None,
+        timezone=timezone_name,
         is_active=True
     )
     session.add(action)
-    session.commit()
+    await session.flush()
+    await notify_schedule_changed(session, action.id)
+    await session.commit()
     return action.id
 
-def delete_scheduled_action(session: Session, action_id: int):
-    action = session.query(ScheduledAction).filter(ScheduledAction.id == action_id).first()
+async def delete_scheduled_action(session: AsyncSession, action_id: int):
+    action = await session.get(ScheduledAction, action_id)
     if action:
-        session.delete(action)
-        session.commit()
+        await session.delete(action)
+        await notify_schedule_changed(session, action_id)
+        await session.commit()
+
+async def notify_schedule_changed(session: AsyncSession, action_id: int):
+    """Notify listening schedulers, Postgres delivers the notification when the transaction commits."""
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": SCHEDULE_CHANNEL, "payload": str(action_id)})
+
+
+async def claim_scheduled_actions(session: AsyncSession, action_ids: list[int], claimed_by: str, lease_seconds: float) -> list[int]:
+    """Claim the due, unclaimed actions among action_ids for one scheduler instance.
+
+    Rows locked by another instance's claim are skipped, expired leases can be claimed again.
+    Returns the ids that were claimed."""
+    now = datetime.now(timezone.utc)
+    query = select(ScheduledAction.id).where(
+        ScheduledAction.id.in_(action_ids),
+        ScheduledAction.trigger_time <= now,
+        ScheduledAction.is_active == True,
+        or_(ScheduledAction.lease_until == None, ScheduledAction.lease_until < now),
+        or_(ScheduledAction.next_attempt_at == None, ScheduledAction.next_attempt_at <= now)
+    )
+    return await _claim(session, query, claimed_by, lease_seconds, now)
+
+async def claim_overdue_actions(session: AsyncSession, overdue_before: datetime, claimed_by: str, lease_seconds: float, limit: int) -> list[int]:
+    """Claim a page of unclaimed actions that were due before overdue_before, grouped by user."""
+    now = datetime.now(timezone.utc)
+    query = select(ScheduledAction.id).where(
+        ScheduledAction.trigger_time < overdue_before,
+        ScheduledAction.is_active == True,
+        or_(ScheduledAction.lease_until == None, ScheduledAction.lease_until < now),
+        or_(ScheduledAction.next_attempt_at == None, ScheduledAction.next_attempt_at <= now)
+    ).order_by(ScheduledAction.user_id, ScheduledAction.trigger_time).limit(limit)
+    return await _claim(session, query, claimed_by, lease_seconds, now)
+
+async def _claim(session: AsyncSession, query, claimed_by: str, lease_seconds: float, now: datetime) -> list[int]:
+    claimed_ids = list((await session.scalars(query.with_for_update(skip_locked=True))).all())
+
+    if claimed_ids:
+        await session.execute(
+            update(ScheduledAction).where(ScheduledAction.id.in_(claimed_ids))
+            .values(claimed_by=claimed_by, lease_until=now + timedelta(seconds=lease_seconds))
+            .execution_options(synchronize_session=False)
+        )
+    await session.commit()
+    return claimed_ids
+
+async def extend_lease(session: AsyncSession, action_ids: list[int], claimed_by: str, lease_seconds: float) -> list[int]:
+    """Renew the lease on the actions among action_ids that are still claimed by this instance.
+
+    Returns their ids, the others were released or taken over by another instance. The caller commits."""
+    now = datetime.now(timezone.utc)
+    return list((await session.scalars(
+        update(ScheduledAction).where(
+            ScheduledAction.id.in_(action_ids),
+            ScheduledAction.claimed_by == claimed_by,
+            ScheduledAction.is_active == True
+        )
+        .values(lease_until=now + timedelta(seconds=lease_seconds))
+        .returning(ScheduledAction.id)
+        .execution_options(synchronize_session=False)
+    )).all())
+
+def release_scheduled_action(session: AsyncSession, action: ScheduledAction):
+    action.claimed_by = None
+    action.lease_until = None
+
+def dead_letter_scheduled_action(session: AsyncSession, action: ScheduledAction, error: str, permanent: bool):
+    """Record an action that won't be retried, the caller deactivates or reschedules it."""
+    session.add(DeadLetterAction(
+        action_id=action.id,
+        user_id=action.user_id,
+        description=action.description,
+        trigger_time=action.trigger_time,
+        recurrence_rule=action.recurrence_rule,
+        message=action.prepared_message,
+        attempts=action.attempts,
+        error=error,
+        permanent=permanent
+    ))
@@ -0,0 +1,75 @@
+"""Inspect and requeue scheduled actions that were moved to the dead letters.
+
+usage: python dead_letters.py list [--user USER_ID] [--limit 50]
+       python dead_letters.py show ID
+       python dead_letters.py requeue ID
+       python dead_letters.py purge --older-than DAYS
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from db_utils import SCHEDULE_CHANNEL, get_session
+from models import DeadLetterAction, ScheduledAction
+
+def list_dead_letters(session, user_id: int | None, limit: int):
+    query = session.query(DeadLetterAction).order_by(DeadLetterAction.failed_at.desc())
+    if user_id is not None:
+        query = query.filter(DeadLetterAction.user_id == user_id)
+    for dead_letter in query.limit(limit).all():
+        kind = "permanent" if dead_letter.permanent else f"{dead_letter.attempts} attempts"
+        print(f"{dead_letter.id}\t{dead_letter.failed_at:%Y-%m-%d %H:%M}\tuser {dead_letter.user_id}\taction {dead_letter.action_id}\t{kind}\t{dead_letter.error}")
+
+def show_dead_letter(session, dead_letter: DeadLetterAction):
+    for column in DeadLetterAction.__table__.columns:
+        print(f"{column.name}: {getattr(dead_letter, column.name)}")
+
+def requeue_dead_letter(session, dead_letter: DeadLetterAction):
+    """Schedule a one-off copy of the action now, with the message it could not send."""
+    now = datetime.now(timezone.utc)
+    action = ScheduledAction(
+        user_id=dead_letter.user_id,
+        description=dead_letter.description,
+        trigger_time=now,
+        prepared_message=dead_letter.message,
+        prepared_at=now if dead_letter.message else None,
+        is_active=True
+    )
+    session.add(action)
+    session.delete(dead_letter)
+    session.flush()
+    session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": SCHEDULE_CHANNEL, "payload": str(action.id)})
+    session.commit()
+    print(f"Requeued as action {action.id}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list")
+    list_parser.add_argument("--user", type=int)
+    list_parser.add_argument("--limit", type=int, default=50)
+    commands.add_parser("show").add_argument("id", type=int)
+    commands.add_parser("requeue").add_argument("id", type=int)
+    commands.add_parser("purge").add_argument("--older-than", type=int, required=True, metavar="DAYS")
+    args = parser.parse_args()
+
+    with get_session() as session:
+        if args.command == "list":
+            list_dead_letters(session, args.user, args.limit)
+        elif args.command == "purge":
+            deleted = session.query(DeadLetterAction).filter(
+                DeadLetterAction.failed_at < datetime.now(timezone.utc) - timedelta(days=args.older_than)
+            ).delete(synchronize_session=False)
+            session.commit()
+            print(f"Deleted {deleted} dead letters")
+        else:
+            dead_letter = session.get(DeadLetterAction, args.id)
+            if dead_letter is None:
+                sys.exit(f"Dead letter {args.id} not found")
+            if args.command == "show":
+                show_dead_letter(session, dead_letter)
+            else:
+                requeue_dead_letter(session, dead_letter)
+
+if __name__ == "__main__":
+    main()
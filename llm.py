@@ -1,173 +1,409 @@
+import asyncio
+import heapq
+import itertools
 import os
-from typing import Coroutine
-from openai import OpenAI
-import requests
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Coroutine
+import httpx
+import openai
+from openai import AsyncOpenAI
 import structlog
-from sqlalchemy.orm import Session
-from db_utils import get_scheduled_actions_for_user
-from models import Conversation, User, Translation
-from database import SessionLocal
-from utils import format_scheduled_actions
+from db_utils import UserContext
+from models import User
+from translation import TranslationService
+import write_behind
+from context_budget import ContextBudget
 from datetime import datetime, timezone
 import json
-from datetime import datetime
 from settings import settings
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
-
-client = OpenAI(api_key=settings.openai_api_key)
-# Create a cache for translations
-translation_cache = {}
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
 
 logger = structlog.get_logger()
 
 async def dummy():
     raise NotImplementedError
 
+# Admission lanes, in priority order
+LANE_INTERACTIVE = "interactive"
+LANE_TRANSLATION = "translation"
+LANE_SCHEDULED = "scheduled"
+LANES = (LANE_INTERACTIVE, LANE_TRANSLATION, LANE_SCHEDULED)
+
+class LLMOverloadedError(Exception):
+    """Raised when a request waited longer than its lane's deadline for an LLM slot."""
+
+class AdmissionController:
+    """Limits the number of concurrent LLM requests across the whole process.
+
+    Waiting requests are admitted by lane priority (interactive > translation > scheduled),
+    then in arrival order. A request that cannot be admitted within its lane's deadline
+    is shed with LLMOverloadedError. The controller is thread safe and can be shared by
+    coroutines running on different event loops."""
+
+    def __init__(self, max_concurrency: int, deadlines: dict[str, float]):
+        self.max_concurrency = max_concurrency
+        self.deadlines = deadlines
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = []  # heap of [priority, seq, loop, future, granted, cancelled]
+        self._seq = itertools.count()
+        self._metrics = {lane: {"admitted": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0} for lane in LANES}
+
+    def is_idle(self) -> bool:
+        """True if there is spare capacity and nothing is waiting for it."""
+        with self._lock:
+            return self._active < self.max_concurrency and not any(not waiter[5] for waiter in self._waiters)
+
+    def queue_depth(self) -> dict[str, int]:
+        with self._lock:
+            depth = {lane: 0 for lane in LANES}
+            for waiter in self._waiters:
+                if not waiter[5]:
+                    depth[LANES[waiter[0]]] += 1
+            return depth
+
+    def stats(self) -> dict:
+        depth = self.queue_depth()
+        with self._lock:
+            return {
+                "active": self._active,
+                "limit": self.max_concurrency,
+                "lanes": {
+                    lane: {
+                        "queued": depth[lane],
+                        "admitted": metrics["admitted"],
+                        "shed": metrics["shed"],
+                        "wait_avg": metrics["wait_total"] / metrics["admitted"] if metrics["admitted"] else 0.0,
+                        "wait_max": metrics["wait_max"],
+                    }
+                    for lane, metrics in self._metrics.items()
+                },
+            }
+
+    def _record_admission(self, lane: str, waited: float):
+        metrics = self._metrics[lane]
+        metrics["admitted"] += 1
+        metrics["wait_total"] += waited
+        metrics["wait_max"] = max(metrics["wait_max"], waited)
+
+    def _release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = heapq.heappop(self._waiters)
+                if waiter[5]:
+                    continue  # Timed out or cancelled while queued
+                # Hand the slot over directly, the active count stays the same
+                waiter[4] = True
+                waiter[2].call_soon_threadsafe(_wake, waiter[3])
+                return
+            self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, lane: str):
+        priority = LANES.index(lane)
+        enqueued_at = time.monotonic()
+        waiter = None
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                self._record_admission(lane, 0.0)
+            else:
+                loop = asyncio.get_running_loop()
+                waiter = [priority, next(self._seq), loop, loop.create_future(), False, False]
+                heapq.heappush(self._waiters, waiter)
+
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter[3], timeout=self.deadlines[lane])
+            except BaseException as e:
+                with self._lock:
+                    granted = waiter[4]
+                    if not granted:
+                        waiter[5] = True
+                        if isinstance(e, asyncio.TimeoutError):
+                            self._metrics[lane]["shed"] += 1
+                if granted and isinstance(e, asyncio.TimeoutError):
+                    pass  # The slot was handed over just as the deadline expired, use it
+                elif granted:
+                    self._release()
+                    raise
+                elif isinstance(e, asyncio.TimeoutError):
+                    logger.warning("LLM request shed", lane=lane, deadline=self.deadlines[lane], queue_depth=self.queue_depth())
+                    raise LLMOverloadedError(f"No LLM capacity for {lane} request within {self.deadlines[lane]}s") from None
+                else:
+                    raise
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._record_admission(lane, waited)
+            logger.info("LLM request admitted", lane=lane, waited=round(waited, 3), queue_depth=self.queue_depth())
+
+        try:
+            yield
+        finally:
+            self._release()
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+admission = AdmissionController(
+    max_concurrency=settings.llm_max_concurrency,
+    deadlines={
+        LANE_INTERACTIVE: settings.llm_deadline_interactive,
+        LANE_TRANSLATION: settings.llm_deadline_translation,
+        LANE_SCHEDULED: settings.llm_deadline_scheduled,
+    },
+)
+
+# Static system prompt, kept first and identical for every request so it can be served from the prompt cache
+SYSTEM_PROMPT = (
+    "You are a helpful assistant Telegram bot called ThirdWheeler, designed to improve communication between couples. "
+    "If the user's summary contains relevant details, incorporate that context into your responses. "
+    "Help users communicate better by reminding them of things their partner might appreciate or want to see less often."
+)
+
 class LLMWrapper:
     def __init__(self, api_url="http://host.docker.internal:11434/v1", model_name="llama3.1", use_openai=False):
         self.api_url = api_url
         self.model_name = model_name
         self.use_openai = use_openai  # Switch between using OpenAI and the locally hosted model
 
-    async def get_response(self, context_messages, summary=None, user_language='en', tools=None, call_tool : Coroutine = dummy) -> ChatCompletionMessage:
-        messages = []
-
-        # Define the assistant's system prompt
-        system_prompt = (
-            f"You are a helpful assistant Telegram bot called ThirdWheeler, designed to improve communication between couples. "
-            f"Always respond in the user's preferred language: {user_language}. "
-            "If the user's summary contains relevant details, incorporate that context into your responses. "
-            "Help users communicate better by reminding them of things their partner might appreciate or want to see less often."
+        # One pooled keep-alive HTTP client per wrapper, shared by all requests made on its event loop
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.llm_pool_size,
+                max_keepalive_connections=settings.llm_pool_size,
+                keepalive_expiry=settings.llm_keepalive_expiry,
+            ),
+            timeout=settings.llm_timeout,
         )
+        if self.use_openai:
+            self.client = AsyncOpenAI(api_key=settings.openai_api_key, http_client=self.http_client)
+        else:
+            # The locally hosted model (Ollama) exposes an OpenAI compatible API, the key is ignored
+            self.client = AsyncOpenAI(api_key=settings.openai_api_key or "ollama", base_url=self.api_url, http_client=self.http_client)
 
-        # Add the system prompt to the messages
-        messages.append({"role": "system", "content": system_prompt})
+        self.translations = TranslationService(self)
+        self.usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0}
 
+    async def aclose(self):
+        await self.client.close()
+
+    def _build_messages(self, context_messages, summary=None, user_language='en', instructions=None) -> list:
+        """Assemble the prompt from the most static to the most volatile content.
+
+        1. the system prompt and the call site's instructions, identical for every request
+        2. per-user content that changes slowly (language, summary)
+        3. the per-request context (scheduled actions, time, history, message)
+
+        Keeping the long static part first lets the provider (OpenAI prompt caching,
+        Ollama KV cache) reuse it across requests."""
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if instructions:
+            messages.append({"role": "system", "content": instructions})
+
+        user_context = f"Always respond in the user's preferred language: {user_language}."
         if summary:
             # Include the user's summary in the context
-            messages.append({"role": "system", "content": f"User summary: {summary}"})
+            user_context += f"\nUser summary: {summary}"
+        messages.append({"role": "system", "content": user_context})
 
         # Append the conversation context
         if context_messages and len(context_messages) > 0:
             messages.extend(context_messages)
 
-        # Log the request being sent to the LLM
-        logger.info("Sending request to LLM", messages=messages)
+        return messages
+
+    def context_budget(self, instructions=None) -> ContextBudget:
+        """Create the token budget for one request, the static part of the prompt is already accounted for."""
+        return ContextBudget(self.model_name, fixed=[SYSTEM_PROMPT, instructions, "Always respond in the user's preferred language: en."])
+
+    def _record_usage(self, usage, lane: str):
+        """Log and accumulate the token counts of one completion."""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens if details else None) or 0
+        self.usage["requests"] += 1
+        self.usage["prompt_tokens"] += usage.prompt_tokens
+        self.usage["completion_tokens"] += usage.completion_tokens
+        self.usage["cached_prompt_tokens"] += cached_tokens
+        logger.info("LLM token usage", lane=lane, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, cached_prompt_tokens=cached_tokens)
+
+    async def _run_tool_calls(self, messages: list, tool_calls: list[ChatCompletionMessageToolCall], call_tool: Coroutine):
+        """Execute the requested tools concurrently and append their results to the messages.
+
+        At most settings.llm_tool_concurrency tools run at once, results are
+        appended in the order of the tool calls."""
+        semaphore = asyncio.Semaphore(settings.llm_tool_concurrency)
+
+        async def run(tool_call):
+            function_name = tool_call.function.name
+            try:
+                arguments = json.loads(tool_call.function.arguments or "{}")
+            except json.JSONDecodeError as e:
+                logger.warning("Invalid tool call arguments", function_name=function_name, error=str(e))
+                return f"Invalid arguments for tool {function_name}: {e}"
+            async with semaphore:
+                tool_result = await call_tool(function_name, arguments)
+            logger.info("Function call processing completed", function_name=function_name)
+            return tool_result
+
+        results = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+        for tool_call, tool_result in zip(tool_calls, results):
+            messages.append({"role": "tool", 
+                                      "name": tool_call.function.name,
+                                      "content": str(tool_result), 
+                                      "tool_call_id": tool_call.id})
+
+    def _tool_kwargs(self, tools, round: int) -> dict:
+        # Offer the tools until the last round, which has to produce the final answer
+        if not tools or round >= settings.llm_max_tool_rounds:
+            return {}
+        return {"tools": tools, "tool_choice": "auto"}  # Automatically determine if a function call is needed
+
+    async def get_response(self, context_messages, summary=None, user_language='en', tools=None, call_tool : Coroutine = dummy, lane=LANE_SCHEDULED, instructions=None, raise_errors=False) -> ChatCompletionMessage:
+        """Get a complete reply from the LLM.
+
+        Raises LLMOverloadedError when no LLM slot is available in time for the lane. A failed
+        API call is answered with an apology, unless raise_errors is set (e.g. by the scheduler,
+        which retries the action instead)."""
+        messages = self._build_messages(context_messages, summary, user_language, instructions)
 
-        if self.use_openai:
-            # Use OpenAI's API
-            response = client.chat.completions.create(model=self.model_name,
-            messages=messages,
-            tools=tools if tools else [],
-            tool_choice="auto",  # Automatically determine if a function call is needed
-            timeout=60)
-
-            
-            # Process the model's response
-            choice = response.choices[0]
-            response_message = choice.message
-            messages.append(response_message)
-
-            if choice.message.tool_calls:
-                for tool_call in choice.message.tool_calls:
-                    arguments = json.loads(tool_call.function.arguments)
-                    function_name = tool_call.function.name
-                    tool_result = await call_tool(function_name, arguments)
-                    logger.info("Function call processing completed", function_name=function_name)
-                    messages.append({"role": "tool", 
-                                              "name": function_name,
-                                              "content": tool_result, 
-                                              "tool_call_id": tool_call.id})
-
-                response = client.chat.completions.create(model=self.model_name,
-                messages=messages,
-                timeout=60)
-            else:
+        # Log the request being sent to the LLM
+        logger.info("Sending request to LLM", messages=messages, use_openai=self.use_openai)
+
+        try:
+            for round in range(settings.llm_max_tool_rounds + 1):
+                async with admission.slot(lane):
+                    response = await self.client.chat.completions.create(model=self.model_name,
+                    messages=messages,
+                    timeout=settings.llm_timeout,
+                    **self._tool_kwargs(tools, round))
+                self._record_usage(response.usage, lane)
+
+                # Process the model's response
+                choice = response.choices[0]
+                if not choice.message.tool_calls:
+                    break
+                messages.append(choice.message)
+                await self._run_tool_calls(messages, choice.message.tool_calls, call_tool)
+            if round == 0:
                 logger.info("no function calls were made")
+        except openai.APIError as e:
+            logger.error("LLM API call failed", error=str(e))
+            if raise_errors:
+                raise
+            return ChatCompletionMessage(role="assistant", content="Sorry, something went wrong while processing your request.")
 
-            message_content = response.choices[0].message
-        else:
-            # Use the locally hosted model via API
-            response = requests.post(
-                f"{self.api_url}/chat/completions",
-                json={
-                    "model": self.model_name,
-                    "messages": messages,
-                    "functions": functions if functions else [],
-                    "function_call": "auto"  # Automatically determine if a function call is needed
-                }
-            ,timeout=60)
-
-            # Handle possible errors in the API response
-            if response.status_code != 200:
-                logger.error("LLM API call failed", status_code=response.status_code, response_text=response.text)
-                return {"content": "Sorry, something went wrong while processing your request."}
-
-            response_json = response.json()
-            message_content = response_json['choices'][0]['message']
+        message_content = response.choices[0].message
 
         # Log the response received from the LLM
-        logger.info("Received response from LLM", response=message_content)
+        logger.info("Received response from LLM", response=message_content, tool_rounds=round)
 
         return message_content
 
-    def translate(self, text, target_language):
-        if target_language == "en":
-            return text  # default strings are in English, no translation needed
-        # Check local cache first
-        if (text, target_language) in translation_cache:
-            return translation_cache[(text, target_language)]
-
-        # Check the database
-        session = SessionLocal()
-        translation = session.query(Translation).filter_by(
-            original_text=text, target_language=target_language
-        ).first()
-
-        if translation:
-            # Cache the translation locally
-            translation_cache[(text, target_language)] = translation.translated_text
-            session.close()
-            return translation.translated_text
-
-        # If translation is not found, use the locally hosted LLM or OpenAI API to translate
-        if self.use_openai:
-            response = client.completions.create(model=self.model_name,
-            prompt=f"Translate the following text to {target_language}: {text}",
-            max_tokens=60)
-            translated_text = response.choices[0].text.strip()
-        else:
-            response = requests.post(
-                f"{self.api_url}/completions",
-                json={
-                    "model": self.model_name,
-                    "prompt": f"Translate the following text to {target_language}: {text}",
-                    "max_tokens": 60
-                }
-            )
-
-            if response.status_code != 200:
-                logger.error("LLM API call failed during translation", status_code=response.status_code, response_text=response.text)
-                return text  # Fallback to the original text if translation fails
-
-            response_json = response.json()
-            translated_text = response_json['choices'][0]['text'].strip()
-
-        # Cache and store the translation in the database
-        translation_cache[(text, target_language)] = translated_text
-        new_translation = Translation(
-            original_text=text,
-            target_language=target_language,
-            translated_text=translated_text
-        )
-        session.add(new_translation)
-        session.commit()
-        session.close()
-
-        # Log the successful translation
-        logger.info("Text translated successfully", original_text=text, translated_text=translated_text, target_language=target_language)
-
-        return translated_text
+    async def stream_response(self, context_messages, summary=None, user_language='en', tools=None, call_tool : Coroutine = dummy, lane=LANE_INTERACTIVE, instructions=None) -> AsyncIterator[str]:
+        """Like get_response, but yields the text of the reply as it is generated.
+
+        Tool call fragments are accumulated while streaming and executed once the
+        model is done with them, the next round of the answer is streamed as well."""
+        messages = self._build_messages(context_messages, summary, user_language, instructions)
+
+        logger.info("Sending streaming request to LLM", messages=messages, use_openai=self.use_openai)
+
+        text = ""
+        try:
+            for round in range(settings.llm_max_tool_rounds + 1):
+                content, tool_calls = "", {}
+                async with admission.slot(lane):
+                    stream = await self.client.chat.completions.create(model=self.model_name,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=settings.llm_timeout,
+                    **self._tool_kwargs(tools, round))
+
+                    async for chunk in stream:
+                        # The usage is reported in a last chunk without choices
+                        self._record_usage(chunk.usage, lane)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        if delta.content:
+                            # Separate the text of consecutive rounds
+                            if not content and text:
+                                yield "\n\n"
+                            content += delta.content
+                            yield delta.content
+                        # Tool calls arrive in fragments, keyed by their index in the final message
+                        for fragment in delta.tool_calls or []:
+                            tool_call = tool_calls.setdefault(fragment.index, {"id": "", "name": "", "arguments": ""})
+                            if fragment.id:
+                                tool_call["id"] = fragment.id
+                            if fragment.function and fragment.function.name:
+                                tool_call["name"] += fragment.function.name
+                            if fragment.function and fragment.function.arguments:
+                                tool_call["arguments"] += fragment.function.arguments
+                text += content
+
+                if not tool_calls:
+                    break
+                calls = [
+                    ChatCompletionMessageToolCall(id=call["id"], type="function", function=Function(name=call["name"], arguments=call["arguments"]))
+                    for _, call in sorted(tool_calls.items())
+                ]
+                messages.append({"role": "assistant", "content": content or None, "tool_calls": [call.model_dump() for call in calls]})
+                await self._run_tool_calls(messages, calls, call_tool)
+            if round == 0:
+                logger.info("no function calls were made")
+        except LLMOverloadedError:
+            yield "I'm a bit overwhelmed right now, please try again in a moment."
+            return
+        except openai.APIError as e:
+            logger.error("LLM API call failed", error=str(e))
+            yield "Sorry, something went wrong while processing your request."
+            return
+
+        logger.info("Received streamed response from LLM", response=text, tool_rounds=round)
+
+    async def translate(self, text, target_language):
+        return await self.translations.translate(text, target_language)
+
+    async def translate_with_llm(self, text, target_language) -> str:
+        """Translate a text with the LLM, raises if the model is unavailable or overloaded."""
+        async with admission.slot(LANE_TRANSLATION):
+            response = await self.client.chat.completions.create(model=self.model_name,
+            messages=[
+                {"role": "system", "content": f"Translate the user's message to {target_language}. Keep placeholders in curly braces, like {{name}}, unchanged. Reply with the translation only."},
+                {"role": "user", "content": text},
+            ],
+            timeout=settings.llm_timeout)
+        self._record_usage(response.usage, LANE_TRANSLATION)
+        return response.choices[0].message.content.strip()
+
+    async def translate_many_with_llm(self, texts: list[str], target_language) -> list[str]:
+        """Translate several texts with one structured LLM call, raises if the answer doesn't match the input."""
+        async with admission.slot(LANE_TRANSLATION):
+            response = await self.client.chat.completions.create(model=self.model_name,
+            messages=[
+                {"role": "system", "content": (
+                    f"Translate each string of the JSON array in the user's message to {target_language}. "
+                    "Keep placeholders in curly braces, like {name}, unchanged. "
+                    'Reply with a JSON object of the form {"translations": [...]} containing the translations in the same order.'
+                )},
+                {"role": "user", "content": json.dumps(texts, ensure_ascii=False)},
+            ],
+            response_format={"type": "json_object"},
+            timeout=settings.llm_timeout)
+        self._record_usage(response.usage, LANE_TRANSLATION)
+        translations = json.loads(response.choices[0].message.content)["translations"]
+        if len(translations) != len(texts) or not all(isinstance(translation, str) for translation in translations):
+            raise ValueError(f"Expected {len(texts)} translations, got {translations!r}")
+        return [translation.strip() for translation in translations]
 
 
 def setup_llm() -> LLMWrapper:
@@ -179,19 +415,27 @@ def setup_llm() -> LLMWrapper:
 def get_user_summary(user: User) -> str:
     return user.summary if user.summary else ""
 
-def prepare_context_messages(session: Session, user: User, user_summary: str, message: str) -> list:
-    user_history = session.query(Conversation).filter(Conversation.user_id == user.telegram_id).count()
-    scheduled_actions = get_scheduled_actions_for_user(session, user.telegram_id)
-    formatted_actions = format_scheduled_actions(scheduled_actions)
-
+def prepare_context_messages(user: UserContext, user_summary: str, message: str, budget: ContextBudget) -> list:
     context_messages = []
 
-    if user_history == 0 and not user_summary:
+    if not user.has_history and not user_summary:
         context_messages.append({"role": "system", "content": get_hidden_intro_message()})
+        budget.reserve(get_hidden_intro_message())
 
     current_time = datetime.now(timezone.utc).isoformat()
-    context_messages.append({"role": "system", "content": f"The current system time is {current_time} UTC."})
+    time_message = f"The current system time is {current_time} UTC."
+    budget.reserve(time_message)
+    budget.reserve(message)
+    formatted_actions = budget.format_actions(user.actions)
+    archive = budget.fit_archive(user.archive)
+
+    # Older conversations were compacted by retention.py, they can still be folded into the summary
+    if archive:
+        context_messages.append({"role": "system", "content": f"Earlier conversations with the user, from the archive of {archive}"})
+
+    # Most volatile content last: the actions change now and then, the time on every request
     context_messages.append({"role": "system", "content": formatted_actions})
+    context_messages.append({"role": "system", "content": time_message})
     context_messages.append({"role": "user", "content": message})
 
     return context_messages
@@ -208,11 +452,12 @@ def get_hidden_intro_message() -> str:
         "Once this information is gathered, store it in the user's summary so that you don't need to ask again."
     )
 
-async def save_conversation(session: Session, user_id: int, message: str):
-    conversation = Conversation(
+async def save_conversation(user_id: int, message: str):
+    """Queue the message for the write-behind buffer, it is inserted with the next bulk flush."""
+    await write_behind.conversations.add(
         couple_id=None,  # This is a user-specific interaction, not a couple interaction
         user_id=user_id,
-        message=message
+        message=message,
+        timestamp=datetime.now(timezone.utc)
     )
-    session.add(conversation)
 
@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger, Column, Integer, String, Text, ForeignKey, DateTime, Boolean
+from sqlalchemy import BigInteger, Column, Date, DDL, Float, Integer, String, Text, ForeignKey, DateTime, Boolean, Index, UniqueConstraint, event, func, text
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 
@@ -26,18 +26,45 @@ class Couple(Base):
     user2 = relationship('User', foreign_keys=[user2_id])
     conversations = relationship('Conversation', back_populates='couple')
 
+    __table_args__ = (
+        # check_user_linked looks up both sides (user1_id = x OR user2_id = x)
+        Index('ix_couples_user1_id', 'user1_id'),
+        Index('ix_couples_user2_id', 'user2_id'),
+    )
+
 class Conversation(Base):
     __tablename__ = 'conversations'
     
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     couple_id = Column(BigInteger, ForeignKey('couples.id'))
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
     message = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow, server_default=text("(now() AT TIME ZONE 'utc')"))  # Partition key, part of the primary key
 
     couple = relationship('Couple', back_populates='conversations')
     user = relationship('User', back_populates='conversations')
 
+    __table_args__ = (
+        Index('ix_conversations_user_id_timestamp', 'user_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},  # Monthly partitions, see retention.py
+    )
+
+class ConversationArchive(Base):
+    """Compacted conversations of a user in a month whose partition was removed, see retention.py."""
+    __tablename__ = 'conversation_archives'
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)  # No foreign key, deleted with the rest of the user's data in confirm_delete
+    month = Column(Date, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_message_at = Column(DateTime, nullable=False)
+    last_message_at = Column(DateTime, nullable=False)
+    messages = Column(Text, nullable=False)  # The most recent messages of the month, shortened, oldest first
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'month', name='uq_conversation_archives_user_id_month'),
+    )
+
 class ScheduledAction(Base):
     __tablename__ = 'scheduled_actions'
     
@@ -46,16 +73,65 @@ class ScheduledAction(Base):
     description = Column(Text, nullable=False)  # Description of what will be done for the LLM
     trigger_time = Column(DateTime, nullable=False)  # When the action should be triggered
     is_active = Column(Boolean, default=True)  # Mark if the action is active
+    recurrence_rule = Column(Text, nullable=True)  # iCalendar RRULE, the action is rescheduled to its next occurrence after triggering
+    recurrence_start = Column(DateTime, nullable=True)  # First occurrence of the series, the rule is evaluated from there so COUNT ends it
+    timezone = Column(String, nullable=True)  # IANA timezone the recurrence rule is evaluated in, UTC if not set
+    prepared_message = Column(Text, nullable=True)  # Message generated ahead of the trigger time
+    prepared_at = Column(DateTime, nullable=True)  # When prepared_message was generated, newer conversations make it stale
+    claimed_by = Column(String, nullable=True)  # Scheduler instance currently triggering the action
+    lease_until = Column(DateTime, nullable=True)  # The claim expires after this time and the action can be claimed again
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')  # Failed trigger attempts of the current occurrence
+    next_attempt_at = Column(DateTime, nullable=True)  # Failed actions are retried with backoff, not before this time
+    last_error = Column(Text, nullable=True)
 
     user = relationship("User", back_populates="scheduled_actions")
 
+    __table_args__ = (
+        # Partial indexes, only the active actions are ever queried
+        Index('ix_scheduled_actions_due', 'trigger_time', postgresql_where=text('is_active')),
+        Index('ix_scheduled_actions_user_id_active', 'user_id', postgresql_where=text('is_active')),
+    )
+
+class DeadLetterAction(Base):
+    """Scheduled action that failed permanently or ran out of attempts, kept for inspection (see dead_letters.py)."""
+    __tablename__ = 'dead_letter_actions'
+
+    id = Column(Integer, primary_key=True)
+    action_id = Column(Integer, nullable=False)  # No foreign key, the action may be deleted in the meantime
+    user_id = Column(BigInteger, nullable=False)
+    description = Column(Text, nullable=False)
+    trigger_time = Column(DateTime, nullable=False)
+    recurrence_rule = Column(Text, nullable=True)
+    message = Column(Text, nullable=True)  # Generated message that could not be sent
+    attempts = Column(Integer, nullable=False)
+    error = Column(Text, nullable=False)
+    permanent = Column(Boolean, nullable=False)  # e.g. the user blocked the bot, retrying won't help
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_dead_letter_actions_failed_at', 'failed_at'),
+    )
+
 class UserActionLog(Base):
     __tablename__ = 'user_action_logs'
     
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id'))
     action = Column(String, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow, server_default=text("(now() AT TIME ZONE 'utc')"))  # Partition key, part of the primary key
+
+    __table_args__ = (
+        Index('ix_user_action_logs_user_id_timestamp', 'user_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},  # Monthly partitions, see retention.py
+    )
+
+class RateLimitBucket(Base):
+    """Token bucket of the shared rate limiter, see rate_limit.PostgresRateLimiter."""
+    __tablename__ = 'rate_limit_buckets'
+
+    key = Column(BigInteger, primary_key=True)  # Telegram id of the user
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
 
 class PendingCouple(Base):
     __tablename__ = 'pending_couples'
@@ -71,11 +147,21 @@ class PendingCouple(Base):
 class Translation(Base):
     __tablename__ = 'translations'
 
-    id = Column(BigInteger, primary_key=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     original_text = Column(Text, nullable=False)
     target_language = Column(String, nullable=False)
     translated_text = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow, server_default=text("(now() AT TIME ZONE 'utc')"))  # Partition key, part of the primary key
+
+    __table_args__ = (
+        # Hash of the text, long texts exceed the maximum btree entry size. Lookups compare the hash and the text itself
+        Index('ix_translations_original_text_target_language', func.md5(original_text), 'target_language'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},  # Monthly partitions, see retention.py
+    )
 
     def __repr__(self):
         return f"<Translation(original_text='{self.original_text}', target_language='{self.target_language}', translated_text='{self.translated_text}')>"
+
+# Rows need a partition to go to, retention.py creates the monthly ones
+for table in (Conversation.__table__, UserActionLog.__table__, Translation.__table__):
+    event.listen(table, 'after_create', DDL('CREATE TABLE IF NOT EXISTS %(table)s_default PARTITION OF %(table)s DEFAULT'))
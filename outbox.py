@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+import structlog
+from telegram.error import RetryAfter
+from settings import settings
+
+logger = structlog.get_logger()
+
+# Send priorities, lower is sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+PRIORITIES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_SCHEDULED: "scheduled"}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # Set from a 429 retry_after
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+class Outbox:
+    """Central queue for all outgoing Telegram calls.
+
+    Calls are sent within Telegram's limits: a global token bucket (~30 messages/s) and
+    one bucket per chat (~1 message/s). Interactive replies are sent before scheduled
+    messages, calls to the same chat keep their order within a priority. A call answered
+    with 429 is retried after the returned retry_after, the chat is paused until then.
+
+    Usage: await outbox.submit(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text))"""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queue = []  # [priority, seq, chat_id, send, future, submitted_at, retries]
+        self._busy = set()  # chats with a call in flight
+        self._sending = set()  # send tasks, referenced until done
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._metrics = {name: {"sent": 0, "failed": 0, "rate_limited": 0, "latency_total": 0.0, "latency_max": 0.0} for name in PRIORITIES.values()}
+
+    def stats(self) -> dict:
+        depth = {name: 0 for name in PRIORITIES.values()}
+        for entry in self._queue:
+            depth[PRIORITIES[entry[0]]] += 1
+        return {
+            "in_flight": len(self._busy),
+            "chats": len(self._chats),
+            "priorities": {
+                name: {
+                    "queued": depth[name],
+                    "sent": metrics["sent"],
+                    "failed": metrics["failed"],
+                    "rate_limited": metrics["rate_limited"],
+                    "latency_avg": metrics["latency_total"] / metrics["sent"] if metrics["sent"] else 0.0,
+                    "latency_max": metrics["latency_max"],
+                }
+                for name, metrics in self._metrics.items()
+            },
+        }
+
+    async def submit(self, chat_id: int, send: Callable[[], Awaitable[Any]], priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """Queue a Telegram call for a chat and return its result once it was sent."""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append([priority, next(self._seq), chat_id, send, future, time.monotonic(), 0])
+        self._wakeup.set()
+        return await future
+
+    async def close(self):
+        """Stop the dispatcher, queued calls are cancelled."""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for entry in self._queue:
+            entry[4].cancel()
+        self._queue.clear()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_ready(self, now: float):
+        """Return the next call that may be sent now, or None and how long to wait."""
+        global_delay = self._global.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+        delay = None
+        seen = set()
+        self._queue.sort(key=lambda entry: (entry[0], entry[1]))
+        for entry in self._queue:
+            chat_id = entry[2]
+            if chat_id in seen or chat_id in self._busy:
+                continue
+            seen.add(chat_id)
+            chat_delay = self._chat_bucket(chat_id).delay(now)
+            if chat_delay <= 0:
+                return entry, 0.0
+            delay = chat_delay if delay is None else min(delay, chat_delay)
+        return None, delay
+
+    async def _dispatch(self):
+        while True:
+            self._queue = [entry for entry in self._queue if not entry[4].done()]  # Drop calls whose caller gave up
+            now = time.monotonic()
+            entry, delay = self._next_ready(now)
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._queue.remove(entry)
+            self._global.take(now)
+            self._chat_bucket(entry[2]).take(now)
+            self._busy.add(entry[2])
+            task = asyncio.create_task(self._send(entry))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+            self._prune(now)
+
+    async def _send(self, entry):
+        priority, _, chat_id, send, future, submitted_at, retries = entry
+        metrics = self._metrics[PRIORITIES[priority]]
+        try:
+            result = await send()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            metrics["rate_limited"] += 1
+            logger.warning("Telegram rate limit hit", chat_id=chat_id, retry_after=retry_after, retries=retries)
+            self._chat_bucket(chat_id).paused_until = time.monotonic() + retry_after
+            if retries < self.max_retries and not future.done():
+                entry[6] += 1
+                self._queue.append(entry)
+            elif not future.done():
+                metrics["failed"] += 1
+                future.set_exception(e)
+        except Exception as e:
+            metrics["failed"] += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            latency = time.monotonic() - submitted_at
+            metrics["sent"] += 1
+            metrics["latency_total"] += latency
+            metrics["latency_max"] = max(metrics["latency_max"], latency)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            self._wakeup.set()
+
+    def _prune(self, now: float):
+        """Forget the buckets of idle chats."""
+        if len(self._chats) <= settings.outbox_max_chats:
+            return
+        queued = {entry[2] for entry in self._queue}
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if chat_id not in queued and chat_id not in self._busy and bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+outbox = Outbox(settings.outbox_global_rate, settings.outbox_chat_rate, settings.outbox_chat_burst, settings.outbox_max_retries)
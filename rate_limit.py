@@ -0,0 +1,87 @@
+import time
+from typing import NamedTuple
+import structlog
+from sqlalchemy import text
+from database import async_engine
+from settings import settings
+
+logger = structlog.get_logger()
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    retry_after: float  # Seconds until the request would be allowed, 0 if it is
+
+class MemoryRateLimiter:
+    """Token bucket per user, kept in process.
+
+    Each user can spend up to burst tokens at once, tokens refill at rate per second."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated_at)
+
+    async def acquire(self, key: int, cost: float = 1) -> RateLimitResult:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return RateLimitResult(False, (cost - tokens) / self.rate)
+        self._buckets[key] = (tokens - cost, now)
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+        return RateLimitResult(True, 0.0)
+
+    def _prune(self, now: float):
+        """Forget the buckets that are full again, they are equal to a new bucket."""
+        for key in [key for key, (tokens, updated_at) in self._buckets.items() if tokens + (now - updated_at) * self.rate >= self.burst]:
+            del self._buckets[key]
+
+class PostgresRateLimiter:
+    """Token bucket per user in the rate_limit_buckets table, shared by all bot processes.
+
+    Refill and spending happen in a single atomic upsert, a second query computes the
+    retry-after hint only for denied requests."""
+
+    # Explicit casts, asyncpg prepares the statements and Postgres can't infer the type of bare parameters in arithmetic
+    ACQUIRE = text("""
+        INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated_at)
+        VALUES (CAST(:key AS bigint), CAST(:initial_tokens AS double precision), clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(CAST(:burst AS double precision), bucket.tokens + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * CAST(:rate AS double precision)) - CAST(:cost AS double precision),
+            updated_at = clock_timestamp()
+        WHERE LEAST(CAST(:burst AS double precision), bucket.tokens + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * CAST(:rate AS double precision)) >= CAST(:cost AS double precision)
+        RETURNING tokens
+    """)
+    AVAILABLE = text("""
+        SELECT LEAST(CAST(:burst AS double precision), tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * CAST(:rate AS double precision))
+        FROM rate_limit_buckets WHERE key = CAST(:key AS bigint)
+    """)
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+    async def acquire(self, key: int, cost: float = 1) -> RateLimitResult:
+        params = {"key": key, "cost": float(cost), "rate": float(self.rate), "burst": float(self.burst), "initial_tokens": float(self.burst - cost)}
+        async with async_engine.begin() as connection:
+            if (await connection.execute(self.ACQUIRE, params)).first() is not None:
+                return RateLimitResult(True, 0.0)
+            tokens = (await connection.execute(self.AVAILABLE, params)).scalar() or 0.0
+        return RateLimitResult(False, max((cost - tokens) / self.rate, 0.0))
+
+def command_cost(message_text: str | None) -> float:
+    """Cost of a message or command, commands are looked up by name without the slash."""
+    if message_text and message_text.startswith("/"):
+        command = message_text.split()[0][1:].split("@")[0]
+        return settings.rate_limit_costs.get(command, settings.rate_limit_costs.get("command", 1))
+    return settings.rate_limit_costs.get("message", 1)
+
+def create_rate_limiter():
+    if settings.rate_limit_backend == "postgres":
+        return PostgresRateLimiter(settings.rate_limit_rate, settings.rate_limit_burst)
+    return MemoryRateLimiter(settings.rate_limit_rate, settings.rate_limit_burst)
+
+rate_limiter = create_rate_limiter()
@@ -0,0 +1,192 @@
+"""Create and retire the monthly partitions of the conversation and log tables.
+
+conversations, user_action_logs and translations are partitioned by month on their
+timestamp (partitions named e.g. conversations_y2026m10). Each run creates the partitions
+of the coming months and removes the months that are older than the table's policy in
+settings.retention_policies:
+
+  drop     the partition is detached and dropped
+  detach   the partition is detached and kept as a standalone table, e.g. to be dumped and archived elsewhere
+  compact  conversations only: the most recent messages of each user and month are compacted
+           into conversation_archives, which still feeds the prompts, then the partition is dropped
+
+keep_months full months are kept besides the current one. Tables without a policy are kept forever.
+The bot runs it every retention_interval seconds, only one process at a time.
+
+usage: python retention.py [--dry-run]
+"""
+import argparse
+import asyncio
+import re
+from datetime import date, datetime, timezone
+import structlog
+from sqlalchemy import text
+from database import async_engine
+from settings import settings
+
+logger = structlog.get_logger()
+
+PARTITIONED_TABLES = ("conversations", "user_action_logs", "translations")
+ACTIONS = ("drop", "detach", "compact")
+PARTITION_NAME = re.compile(r"(\w+)_y(\d{4})m(\d{2})")
+
+# Advisory lock held during a run, so that several bot processes don't run it at the same time
+RETENTION_LOCK = 0x7265746e
+
+PARTITIONS = text("""
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = :table
+""")
+# Formatted with the partition name
+COMPACT = """
+    INSERT INTO conversation_archives (user_id, month, message_count, first_message_at, last_message_at, messages)
+    SELECT user_id, CAST(:month AS date), count(*), min("timestamp"), max("timestamp"),
+           string_agg(left(message, :chars), :separator ORDER BY "timestamp") FILTER (WHERE recent <= :messages)
+    FROM (
+        SELECT user_id, message, "timestamp", row_number() OVER (PARTITION BY user_id ORDER BY "timestamp" DESC) AS recent
+        FROM {partition}
+    ) numbered
+    WHERE user_id IS NOT NULL
+    GROUP BY user_id
+"""
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+def get_policy(table: str) -> dict | None:
+    policy = settings.retention_policies.get(table)
+    if policy is None:
+        return None
+    if policy.get("action") not in ACTIONS or int(policy.get("keep_months", -1)) < 0:
+        raise ValueError(f"Invalid retention policy for {table}: {policy}")
+    if policy["action"] == "compact" and table != "conversations":
+        raise ValueError(f"Only conversations can be compacted, not {table}")
+    return policy
+
+async def list_partitions(connection, table: str) -> dict[date, str]:
+    """Monthly partitions of a table by their first day, the default partition is left out."""
+    partitions = {}
+    for (name,) in await connection.execute(PARTITIONS, {"table": table}):
+        match = PARTITION_NAME.fullmatch(name)
+        if match and match[1] == table:
+            partitions[date(int(match[2]), int(match[3]), 1)] = name
+    return partitions
+
+async def create_partition(connection, table: str, month: date):
+    name = partition_name(table, month)
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    await connection.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    # Rows that went to the default partition while the month had none of its own, they would block the attach
+    await connection.execute(text(f"""
+        WITH moved AS (DELETE FROM {table}_default WHERE "timestamp" >= '{start}' AND "timestamp" < '{end}' RETURNING *)
+        INSERT INTO {name} SELECT * FROM moved
+    """))
+    # Attaching creates the partition's indexes, primary key and foreign keys
+    await connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+
+async def compact_partition(connection, name: str, month: date) -> int:
+    result = await connection.execute(text(COMPACT.format(partition=name)), {
+        "month": month,
+        "chars": settings.retention_archive_message_chars,
+        "messages": settings.retention_archive_messages,
+        "separator": "\n",
+    })
+    return result.rowcount
+
+async def retire_partition(connection, table: str, name: str, month: date, action: str):
+    if action == "compact":
+        users = await compact_partition(connection, name, month)
+        logger.info("Conversations compacted", partition=name, users=users)
+    await connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+    if action != "detach":
+        await connection.execute(text(f"DROP TABLE {name}"))
+
+def plan(table: str, partitions: dict[date, str], current_month: date) -> list[tuple[str, date]]:
+    """Steps for a table, ("create", month) for missing future partitions, (action, month) for expired ones."""
+    steps = [
+        ("create", add_months(current_month, months))
+        for months in range(settings.retention_months_ahead + 1)
+        if add_months(current_month, months) not in partitions
+    ]
+    policy = get_policy(table)
+    if policy is not None:
+        cutoff = add_months(current_month, -int(policy["keep_months"]))
+        steps += [(policy["action"], month) for month in sorted(partitions) if month < cutoff]
+    return steps
+
+async def run_retention(dry_run: bool = False) -> list[str]:
+    """Create upcoming partitions and retire the expired ones, returns the steps taken."""
+    today = datetime.now(timezone.utc).date()
+    current_month = date(today.year, today.month, 1)
+    done = []
+    async with async_engine.connect() as connection:
+        locked = (await connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": RETENTION_LOCK})).scalar()
+        await connection.commit()
+        if not locked:
+            logger.info("Retention already running in another process")
+            return done
+        try:
+            for table in PARTITIONED_TABLES:
+                partitions = await list_partitions(connection, table)
+                await connection.commit()
+                for action, month in plan(table, partitions, current_month):
+                    name = partitions.get(month, partition_name(table, month))
+                    step = f"{action} {name}"
+                    if dry_run:
+                        done.append(step)
+                        continue
+                    # One transaction per step, the DDL gives up instead of queueing the writers behind it
+                    try:
+                        async with connection.begin():
+                            await connection.execute(text(f"SET LOCAL lock_timeout = '{settings.retention_lock_timeout}'"))
+                            if action == "create":
+                                await create_partition(connection, table, month)
+                            else:
+                                await retire_partition(connection, table, name, month, action)
+                    except Exception as e:
+                        logger.error("Retention step failed, retried with the next run", step=step, error=str(e))
+                        continue
+                    logger.info("Retention step done", step=step)
+                    done.append(step)
+        finally:
+            await connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": RETENTION_LOCK})
+            await connection.commit()
+    return done
+
+async def run_periodically():
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logger.error("Retention run failed", error=str(e))
+        await asyncio.sleep(settings.retention_interval)
+
+async def start_retention() -> asyncio.Task | None:
+    """Start the periodic retention as a task on the running loop, None if it is disabled.
+
+    Cancel the returned task to stop it."""
+    if settings.retention_interval <= 0:
+        return None
+    for table in PARTITIONED_TABLES:
+        get_policy(table)  # Fail on startup on a broken policy
+    return asyncio.create_task(run_periodically())
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="only print the steps")
+    args = parser.parse_args()
+    try:
+        for step in await run_retention(args.dry_run):
+            print(step)
+    finally:
+        await async_engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
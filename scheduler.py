@@ -1,42 +1,378 @@
 import asyncio
+import heapq
+import random
 import time
+import asyncpg
 import structlog
-from datetime import datetime, timezone
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import exists, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Bot
-from models import ScheduledAction, Conversation
-from db_utils import get_session, get_current_user
+from telegram.error import BadRequest, Forbidden
+from models import ScheduledAction, Conversation, User
+from database import db_url
+from db_utils import SCHEDULE_CHANNEL, claim_overdue_actions, claim_scheduled_actions, dead_letter_scheduled_action, extend_lease, get_async_session, get_current_user, release_scheduled_action
 from tools import build_call_tool_function, get_llm_functions
-from utils import send_message_to_user
-from llm import get_user_summary, setup_llm, LLMWrapper
+from llm import admission, get_user_summary, LLMWrapper
+from outbox import PRIORITY_SCHEDULED, outbox
+from utils import next_occurrence
+from settings import settings
 
 logger = structlog.get_logger()
 
+# Static instructions for generating action messages, sent ahead of the per-user context
+ACTION_INSTRUCTIONS = "Generate a message for the following action based on the recent conversation context. Do not re-execute the commands from the recent conversation. If it is supposed to be a recurring action, schedule the next action trigger and make sure to add the description of the desired action frequency to the action description for future rescheduling since only one action is scheduled at a time and after triggering it, the next action is scheduled."
+# Recurring actions are rescheduled by the scheduler, the LLM only writes the message
+RECURRING_ACTION_INSTRUCTIONS = "Generate a message for the following action based on the recent conversation context. Do not re-execute the commands from the recent conversation. This is a recurring action, its next occurrence is scheduled automatically, do not schedule it again."
+# Messages generated ahead of the trigger time, no tools are offered
+PREPARE_ACTION_INSTRUCTIONS = "Generate a message for the following action based on the recent conversation context. It will be sent to the user when the action is due."
+# Several overdue actions of one user are combined into a single message
+DIGEST_INSTRUCTIONS = "The following scheduled actions were missed while the bot was unavailable. Generate one short message that covers all of them, mention that they are late and leave out anything that no longer makes sense."
 
-async def start_scheduler(bot_token: str):
-    bot = Bot(token=bot_token)
-    llm = setup_llm()
+
+async def start_scheduler(bot: Bot, llm: LLMWrapper) -> asyncio.Task:
+    """Start the scheduler as a task on the running loop, sharing the bot's Bot and LLM client.
+
+    Cancel the returned task to stop it."""
     logger.info("Scheduler started")
+    return asyncio.create_task(ActionScheduler(bot, llm).run())
+
+
+def as_utc(timestamp: datetime) -> datetime:
+    return timestamp.replace(tzinfo=timezone.utc) if timestamp.tzinfo is None else timestamp
+
+
+class ActionScheduler:
+    """Triggers scheduled actions exactly when they are due.
+
+    Upcoming actions are kept in a min-heap by trigger time and the scheduler sleeps until
+    the next one is due. add/delete_scheduled_action send a Postgres NOTIFY that wakes it up
+    to reload the schedule. A periodic reconciliation reloads it anyway, in case a
+    notification was missed or the listener connection is down.
+
+    Due actions are handed to a pool of workers. All actions of a user go to the same
+    worker, so they are triggered in order.
+
+    Any number of schedulers can run against the same database: an action is only
+    triggered by the instance that claimed it (SELECT ... FOR UPDATE SKIP LOCKED) and the
+    claim expires after a lease time, so actions of a crashed instance are picked up again.
+    The lease is renewed while an action is worked on (see hold_claim) and checked again
+    right before its message is sent.
+
+    While the LLM has spare capacity, the messages of recurring actions due within the
+    look-ahead window are generated in advance, so triggering them only needs the Telegram
+    send. One-time actions are generated at trigger time with tools, older ones only recur
+    because the model schedules their next occurrence there.
+
+    Actions that are overdue by more than the catch-up threshold (e.g. after an outage) are
+    not triggered one by one but drained by a catch-up pass, see _catch_up.
+
+    Failed actions are retried with exponential backoff. Once they fail permanently or run
+    out of attempts they are moved to the dead letters, see record_failure."""
+
+    def __init__(self, bot: Bot, llm: LLMWrapper):
+        self.bot = bot
+        self.llm = llm
+        self._heap = []  # (trigger_time, action_id, user_id) of the active actions due before the next reconciliation
+        self._wakeup = asyncio.Event()
+        self._reload_needed = True
+        self._listen_connection = None
+        self._next_reconcile = 0.0
+        self._queues = [asyncio.Queue() for _ in range(settings.scheduler_workers)]
+        self._pending = set()  # ids of the queued or running actions
+        self._backlog_since = None
+        self._catch_up_task = None
+        self.metrics = {"triggered": 0, "failed": 0, "dead_lettered": 0, "max_lag": 0.0, "last_drain_time": 0.0}
+
+    async def run(self):
+        workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        workers.append(asyncio.create_task(self._lookahead()))
+        try:
+            await self._loop()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if self._catch_up_task is not None:
+                self._catch_up_task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self._unlisten()
+            logger.info("Scheduler stopped")
+
+    async def _loop(self):
+        while True:
+            await self._listen()
+            if self._reload_needed or time.monotonic() >= self._next_reconcile:
+                await self._reload()
+            await self._trigger_due()
+            await self._sleep_until_next()
+
+    async def _listen(self):
+        """(Re)connect the LISTEN connection, asyncpg calls _on_notify for each notification."""
+        if self._listen_connection is not None:
+            return
+        try:
+            connection = await asyncpg.connect(db_url)
+            await connection.add_listener(SCHEDULE_CHANNEL, self._on_notify)
+            connection.add_termination_listener(self._on_listen_lost)
+            self._listen_connection = connection
+            logger.info("Listening for schedule changes", channel=SCHEDULE_CHANNEL)
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error("Failed to listen for schedule changes, relying on reconciliation", error=str(e))
 
-    while True:
-        with get_session() as session:
-            now = datetime.now(timezone.utc)
-            actions_to_trigger = session.query(ScheduledAction).filter(
-                ScheduledAction.trigger_time <= now,
+    async def _unlisten(self):
+        connection = self._listen_connection
+        self._listen_connection = None
+        if connection is not None and not connection.is_closed():
+            await connection.close()
+
+    def _on_listen_lost(self, connection):
+        if connection is not self._listen_connection:
+            return  # Closed by _unlisten
+        logger.error("Schedule listener connection lost")
+        self._listen_connection = None
+        self._reload_needed = True
+        self._wakeup.set()
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        logger.debug("Schedule changed", action_id=payload)
+        self._reload_needed = True
+        self._wakeup.set()
+
+    async def _reload(self):
+        """Load the active actions that are due before the next reconciliation into the heap."""
+        now = datetime.now(timezone.utc)
+        horizon = now + timedelta(seconds=settings.scheduler_reconcile_interval)
+        overdue_before = now - timedelta(seconds=settings.scheduler_catchup_after)
+        async with get_async_session() as session:
+            rows = (await session.execute(select(ScheduledAction.id, ScheduledAction.user_id, ScheduledAction.trigger_time, ScheduledAction.lease_until, ScheduledAction.next_attempt_at).where(
+                ScheduledAction.trigger_time >= overdue_before,
+                ScheduledAction.trigger_time <= horizon,
                 ScheduledAction.is_active == True
-            ).all()
+            ))).all()
+            backlog = await session.scalar(select(exists().where(
+                ScheduledAction.trigger_time < overdue_before,
+                ScheduledAction.is_active == True,
+                or_(ScheduledAction.next_attempt_at == None, ScheduledAction.next_attempt_at <= now)
+            )))
+        if backlog and (self._catch_up_task is None or self._catch_up_task.done()):
+            self._catch_up_task = asyncio.create_task(self._catch_up(overdue_before))
+        # Actions claimed by another instance are due again once their lease expires, failed actions at their next attempt
+        self._heap = [
+            (max(as_utc(time) for time in (trigger_time, lease_until, next_attempt_at) if time), action_id, user_id)
+            for action_id, user_id, trigger_time, lease_until, next_attempt_at in rows if action_id not in self._pending
+        ]
+        heapq.heapify(self._heap)
+        self._reload_needed = False
+        self._next_reconcile = time.monotonic() + settings.scheduler_reconcile_interval
+        logger.debug("Schedule reloaded", upcoming=len(self._heap))
+
+    async def _trigger_due(self):
+        now = datetime.now(timezone.utc)
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            trigger_time, action_id, user_id = heapq.heappop(self._heap)
+            if action_id not in self._pending:
+                due[action_id] = user_id
+        if not due:
+            return
+
+        async with get_async_session() as session:
+            claimed_ids = await claim_scheduled_actions(session, list(due), settings.scheduler_instance_id, settings.scheduler_lease_seconds)
+        if len(claimed_ids) < len(due):
+            logger.debug("Actions claimed by other schedulers", count=len(due) - len(claimed_ids))
+
+        # In heap order, the claim returns the ids in no particular order
+        claimed = set(claimed_ids)
+        for action_id, user_id in due.items():
+            if action_id not in claimed:
+                continue
+            if not self._pending:
+                self._backlog_since = time.monotonic()
+            self._pending.add(action_id)
+            self._queues[user_id % len(self._queues)].put_nowait(action_id)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            action_id = await queue.get()
+            try:
+                await self._trigger(action_id)
+            except Exception as e:
+                logger.error("Scheduler worker error", action_id=action_id, error=str(e))
+            finally:
+                self._pending.discard(action_id)
+                queue.task_done()
+                if not self._pending:
+                    self.metrics["last_drain_time"] = time.monotonic() - self._backlog_since
+                    logger.info("Scheduled actions drained", **self.metrics)
+
+    async def _trigger(self, action_id: int):
+        """Trigger one action in its own session, committing or rolling back just this action.
+
+        No transaction is held while the message is generated, the claim is checked again before the send."""
+        async with get_async_session() as session:
+            # Check again, the action may have been changed since it was loaded
+            action = await session.scalar(select(ScheduledAction).where(
+                ScheduledAction.id == action_id,
+                ScheduledAction.is_active == True,
+                ScheduledAction.claimed_by == settings.scheduler_instance_id
+            ))
+            if not action:
+                return
+
+            lag = (datetime.now(timezone.utc) - as_utc(action.trigger_time)).total_seconds()
+            self.metrics["max_lag"] = max(self.metrics["max_lag"], lag)
+            try:
+                logger.info("Triggering scheduled action", action_id=action.id, lag=round(lag, 3))
+                # The LLM request may wait for admission longer than the lease
+                async with hold_claim([action_id]):
+                    await trigger_action(session, self.bot, self.llm, action)  # Use 'await' for async trigger
+                next_time = finish_action(session, action)
+                await session.commit()
+                self.metrics["triggered"] += 1
+                if next_time:
+                    logger.info("Recurring action rescheduled", action_id=action_id, next_trigger_time=next_time.isoformat())
+                    if next_time <= datetime.now(timezone.utc) + timedelta(seconds=settings.scheduler_reconcile_interval):
+                        heapq.heappush(self._heap, (next_time, action_id, action.user_id))
+                        self._wakeup.set()  # The loop may be sleeping until a later action
+            except LeaseLostError:
+                logger.warning("Claim lost, scheduled action left to the other scheduler", action_id=action_id)
+                await session.rollback()
+            except Exception as e:
+                logger.error("Failed to trigger scheduled action", action_id=action_id, error=str(e))
+                await session.rollback()
+                await session.refresh(action)
+                self.metrics["failed"] += 1
+                next_time = record_failure(session, action, e)
+                await session.commit()
+                if action.next_attempt_at is None:  # Not retried
+                    self.metrics["dead_lettered"] += 1
+                if next_time and next_time <= datetime.now(timezone.utc) + timedelta(seconds=settings.scheduler_reconcile_interval):
+                    heapq.heappush(self._heap, (next_time, action_id, action.user_id))
+                    self._wakeup.set()
+
+    async def _catch_up(self, overdue_before: datetime):
+        """Drain the backlog of overdue actions in bounded time.
+
+        The backlog is claimed in small pages, grouped by user, and the lease on a page is
+        renewed while it is worked on. Before each user the claim is checked again, actions
+        taken over by another instance are skipped. Actions older than the staleness
+        threshold are dropped (recurring ones move on to their next occurrence), the rest of
+        a user's actions are combined into one digest message. Sends are paced so the
+        backlog doesn't flood the LLM and Telegram."""
+        started = time.monotonic()
+        sent = dropped = failed = 0
+        while True:
+            async with get_async_session() as session:
+                action_ids = await claim_overdue_actions(session, overdue_before, settings.scheduler_instance_id, settings.scheduler_lease_seconds, settings.scheduler_catchup_page_size)
+            if not action_ids:
+                break
+
+            async with get_async_session() as session, hold_claim(action_ids):
+                actions = (await session.scalars(select(ScheduledAction).where(ScheduledAction.id.in_(action_ids)).order_by(ScheduledAction.user_id, ScheduledAction.trigger_time))).all()
+                by_user = {}
+                for action in actions:
+                    by_user.setdefault(action.user_id, []).append(action)
+
+                for user_id, user_actions in by_user.items():
+                    held = set(await extend_lease(session, [action.id for action in user_actions], settings.scheduler_instance_id, settings.scheduler_lease_seconds))
+                    await session.commit()
+                    if len(held) < len(user_actions):
+                        logger.warning("Claim lost, overdue actions left to the other scheduler", user_id=user_id, action_ids=[action.id for action in user_actions if action.id not in held])
+                        user_actions = [action for action in user_actions if action.id in held]
+                        if not user_actions:
+                            continue
+                    stale_before = datetime.now(timezone.utc) - timedelta(seconds=settings.scheduler_catchup_stale_after)
+                    stale = [action for action in user_actions if as_utc(action.trigger_time) < stale_before]
+                    current = [action for action in user_actions if as_utc(action.trigger_time) >= stale_before]
+                    try:
+                        if len(current) == 1:
+                            await trigger_action(session, self.bot, self.llm, current[0])
+                            sent += 1
+                        elif current:
+                            user = await get_current_user(session, user_id)
+                            if user:
+                                await send_digest(session, self.bot, self.llm, user, current)
+                                sent += 1
+                        next_times = [(finish_action(session, action), action.id) for action in user_actions]
+                        await session.commit()
+                        horizon = datetime.now(timezone.utc) + timedelta(seconds=settings.scheduler_reconcile_interval)
+                        for next_time, action_id in next_times:
+                            if next_time and next_time <= horizon:
+                                heapq.heappush(self._heap, (next_time, action_id, user_id))
+                                self._wakeup.set()
+                        dropped += len(stale)
+                        if stale:
+                            logger.info("Dropped stale overdue actions", user_id=user_id, action_ids=[action.id for action in stale])
+                    except LeaseLostError:
+                        logger.warning("Claim lost, overdue actions left to the other scheduler", user_id=user_id)
+                        await session.rollback()
+                        for action in actions:  # The rollback expired the whole page
+                            await session.refresh(action)
+                        continue
+                    except Exception as e:
+                        logger.error("Failed to catch up overdue actions", user_id=user_id, error=str(e))
+                        await session.rollback()
+                        failed += len(current)
+                        for action in actions:  # The rollback expired the whole page
+                            await session.refresh(action)
+                        for action in current:
+                            record_failure(session, action, e)
+                        for action in stale:
+                            release_scheduled_action(session, action)
+                        await session.commit()
+                    if current:
+                        await asyncio.sleep(settings.scheduler_catchup_send_interval)
 
-            for action in actions_to_trigger:
-                try:
-                    await trigger_action(session, bot, llm, action)  # Use 'await' for async trigger
-                    # Mark the action as inactive after triggering
-                    action.is_active = False
-                    session.commit()
-                except Exception as e:
-                    logger.error("Failed to trigger scheduled action", action_id=action.id, error=str(e))
-                    session.rollback()
+        logger.info("Overdue backlog drained", duration=round(time.monotonic() - started, 3), messages_sent=sent, dropped=dropped, failed=failed)
 
-        await asyncio.sleep(60)  # Use asyncio.sleep to avoid blocking the event loop
+    async def _lookahead(self):
+        while True:
+            await asyncio.sleep(settings.scheduler_lookahead_interval)
+            try:
+                await self._prepare_upcoming()
+            except Exception as e:
+                logger.error("Failed to prepare upcoming actions", error=str(e))
+
+    async def _prepare_upcoming(self):
+        """Generate messages for the upcoming recurring actions that have none or only a stale one."""
+        now = datetime.now(timezone.utc)
+        async with get_async_session() as session:
+            stale = exists().where(
+                Conversation.user_id == ScheduledAction.user_id,
+                Conversation.timestamp > ScheduledAction.prepared_at
+            )
+            action_ids = (await session.scalars(select(ScheduledAction.id).where(
+                ScheduledAction.trigger_time > now,
+                ScheduledAction.trigger_time <= now + timedelta(seconds=settings.scheduler_lookahead_window),
+                ScheduledAction.is_active == True,
+                ScheduledAction.recurrence_rule != None,
+                or_(ScheduledAction.prepared_message == None, stale)
+            ).order_by(ScheduledAction.trigger_time))).all()
+
+        for action_id in action_ids:
+            # Only use spare LLM capacity, interactive requests come first
+            if not admission.is_idle():
+                logger.debug("LLM busy, postponing message preparation", remaining=len(action_ids))
+                return
+            try:
+                async with get_async_session() as session:
+                    action = await session.get(ScheduledAction, action_id)
+                    if action and action.is_active and action_id not in self._pending:
+                        await prepare_action_message(session, self.bot, self.llm, action)
+            except Exception as e:  # Generated at trigger time instead
+                logger.error("Failed to prepare scheduled action message", action_id=action_id, error=str(e))
+
+    async def _sleep_until_next(self):
+        timeout = self._next_reconcile - time.monotonic()
+        if self._heap:
+            timeout = min(timeout, (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds())
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._wakeup.clear()
 
 
 def format_time_since(timestamp):
@@ -59,44 +395,206 @@ def format_time_since(timestamp):
     else:
         return "just now"
 
-async def trigger_action(session: Session, bot: Bot, llm: LLMWrapper, action: ScheduledAction):
-    user = get_current_user(session, action.user_id)
+def finish_action(session: AsyncSession, action: ScheduledAction) -> datetime | None:
+    """Move a triggered recurring action to its next occurrence or mark the action as inactive.
+
+    Releases the claim on the action, returns the next trigger time if there is one."""
+    series_start = action.recurrence_start or action.trigger_time
+    next_time = next_occurrence(series_start, action.recurrence_rule, action.timezone, datetime.now(timezone.utc)) if action.recurrence_rule else None
+    if next_time:
+        action.trigger_time = next_time
+        action.prepared_message = None
+        action.prepared_at = None
+        action.attempts = 0
+        action.next_attempt_at = None
+        action.last_error = None
+    else:
+        action.is_active = False
+    release_scheduled_action(session, action)
+    return next_time
+
+class LeaseLostError(Exception):
+    """The claim on an action expired and another scheduler instance took it over, it must not be sent here."""
+
+async def verify_claim(session: AsyncSession, actions: list[ScheduledAction]):
+    """Check right before sending that the actions are still claimed by this instance and renew their lease.
+
+    The renewal locks the rows until the caller commits, so the claim can't be taken over during the send."""
+    held = await extend_lease(session, [action.id for action in actions], settings.scheduler_instance_id, settings.scheduler_lease_seconds)
+    if len(held) < len(actions):
+        raise LeaseLostError(f"Actions {sorted({action.id for action in actions} - set(held))} were taken over")
+
+@asynccontextmanager
+async def hold_claim(action_ids: list[int]):
+    """Renew the lease on claimed actions in the background while they are worked on."""
+    async def renew():
+        while True:
+            await asyncio.sleep(settings.scheduler_lease_seconds / 3)
+            try:
+                async with get_async_session() as session:
+                    await extend_lease(session, action_ids, settings.scheduler_instance_id, settings.scheduler_lease_seconds)
+            except Exception as e:
+                logger.error("Failed to renew the lease on scheduled actions", action_ids=action_ids, error=str(e))
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        await asyncio.gather(renewal, return_exceptions=True)
+
+class ActionSendError(Exception):
+    """The message of an action was generated but could not be sent, the cause is the Telegram error."""
+
+    def __init__(self, message: str):
+        super().__init__("Failed to send the action message")
+        self.message = message
+
+def is_permanent_error(error: Exception) -> bool:
+    """Errors that retrying won't fix: the user blocked the bot or the chat is gone."""
+    return isinstance(error, Forbidden) or isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+def record_failure(session: AsyncSession, action: ScheduledAction, error: Exception) -> datetime | None:
+    """Schedule the retry of a failed action with exponential backoff and jitter.
+
+    Actions that failed permanently or ran out of attempts are moved to the dead letters,
+    recurring ones continue with their next occurrence unless the failure is permanent.
+    Releases the claim on the action, returns when it is due again."""
+    if isinstance(error, ActionSendError):
+        # Keep the generated message, the retry only has to send it
+        action.prepared_message = error.message
+        action.prepared_at = datetime.now(timezone.utc)
+        error = error.__cause__
+    action.attempts += 1
+    action.last_error = f"{type(error).__name__}: {error}"
+    permanent = is_permanent_error(error)
+
+    if permanent or action.attempts >= settings.scheduler_max_attempts:
+        logger.error("Scheduled action dead-lettered", action_id=action.id, attempts=action.attempts, permanent=permanent, error=action.last_error)
+        dead_letter_scheduled_action(session, action, action.last_error, permanent)
+        action.next_attempt_at = None
+        if permanent:
+            action.is_active = False
+            release_scheduled_action(session, action)
+            return None
+        return finish_action(session, action)
+
+    delay = min(settings.scheduler_retry_base_delay * 2 ** (action.attempts - 1), settings.scheduler_retry_max_delay)
+    action.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+    release_scheduled_action(session, action)
+    logger.info("Scheduled action retry scheduled", action_id=action.id, attempts=action.attempts, next_attempt_at=action.next_attempt_at.isoformat())
+    return action.next_attempt_at
+
+async def is_prepared_message_fresh(session: AsyncSession, action: ScheduledAction) -> bool:
+    """A prepared message is stale once the user wrote something after it was generated."""
+    if not action.prepared_message:
+        return False
+    return not await session.scalar(select(exists().where(
+        Conversation.user_id == action.user_id,
+        Conversation.timestamp > action.prepared_at
+    )))
+
+async def generate_action_message(session: AsyncSession, bot: Bot, llm: LLMWrapper, user: User, action: ScheduledAction, use_tools: bool = True) -> str:
+    """Generate the message of an action with the LLM.
+
+    Commits the session before the LLM call, the caller must not have pending changes."""
+    # Retrieve the last few messages between the bot and the user
+    recent_conversations = (await session.scalars(select(Conversation).where(
+        Conversation.user_id == user.telegram_id
+    ).order_by(Conversation.timestamp.desc()).limit(5))).all()
+
+    # Prepare the conversation history for the LLM context
+    recent_messages = []
+    for conversation in reversed(recent_conversations):  # Reverse to maintain chronological order
+        time_since = format_time_since(conversation.timestamp)
+        recent_messages.append({
+            "role": "user" if conversation.user_id == user.telegram_id else "assistant",
+            "content": f"{conversation.message} (sent {time_since})"
+        })
+
+    # Prepare the LLM context with the recent messages and action description, within the model's token budget
+    if not use_tools:
+        instructions = PREPARE_ACTION_INSTRUCTIONS
+    else:
+        instructions = RECURRING_ACTION_INSTRUCTIONS if action.recurrence_rule else ACTION_INSTRUCTIONS
+    budget = llm.context_budget(instructions)
+    action_message = {"role": "user", "content": f"Action description: {action.description}"}
+    budget.reserve(action_message["content"])
+    user_summary = budget.fit_summary(get_user_summary(user))
+    context_messages = budget.fit_history(recent_messages) + [action_message]
+    await session.commit()  # Return the connection to the pool while the message is generated
+
+    llm_response = await llm.get_response(context_messages,  
+                                          summary=user_summary,           
+                                          user_language=user.language, 
+                                          tools=get_llm_functions() if use_tools else None,
+                                          call_tool=build_call_tool_function(bot, llm, user, user.language),
+                                          instructions=instructions,
+                                          raise_errors=True)  # Retried with backoff, see record_failure
+    return llm_response.content
+
+async def prepare_action_message(session: AsyncSession, bot: Bot, llm: LLMWrapper, action: ScheduledAction):
+    """Generate the message of an upcoming action ahead of time, without executing any tools."""
+    user = await get_current_user(session, action.user_id)
+    if not user:
+        return
+    message = await generate_action_message(session, bot, llm, user, action, use_tools=False)
+    # The action may have been claimed or triggered while the message was generated, the message is then discarded
+    result = await session.execute(
+        update(ScheduledAction).where(
+            ScheduledAction.id == action.id,
+            ScheduledAction.trigger_time == action.trigger_time,
+            ScheduledAction.is_active == True,
+            ScheduledAction.claimed_by == None
+        )
+        .values(prepared_message=message, prepared_at=datetime.now(timezone.utc))
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        logger.info("Prepared scheduled action message", action_id=action.id, trigger_time=action.trigger_time.isoformat())
+    else:
+        logger.info("Prepared message discarded, the action changed meanwhile", action_id=action.id)
+
+async def trigger_action(session: AsyncSession, bot: Bot, llm: LLMWrapper, action: ScheduledAction):
+    user = await get_current_user(session, action.user_id)
 
     if user:
-        # Retrieve the last few messages between the bot and the user
-        recent_conversations = session.query(Conversation).filter(
-            Conversation.user_id == user.telegram_id
-        ).order_by(Conversation.timestamp.desc()).limit(5).all()
-
-        # Prepare the conversation history for the LLM context
-        recent_messages = []
-        for conversation in reversed(recent_conversations):  # Reverse to maintain chronological order
-            time_since = format_time_since(conversation.timestamp)
-            recent_messages.append({
-                "role": "user" if conversation.user_id == user.telegram_id else "assistant",
-                "content": f"{conversation.message} (sent {time_since})"
-            })
-
-        # Prepare the LLM context with the recent messages and action description
-        context_messages = recent_messages + [
-            {"role": "system", "content": "Generate a message for the following action based on the recent conversation context. Do not re-execute the commands from the recent conversation. If it is supposed to be a recurring action, schedule the next action trigger and make sure to add the description of the desired action frequency to the action description for future rescheduling since only one action is scheduled at a time and after triggering it, the next action is scheduled."},
-            {"role": "user", "content": f"Action description: {action.description}"}
-        ]
+        # One-time actions need the pass with tools, their prepared message can only be from a failed send whose tools already ran
+        prepared = (action.recurrence_rule or action.attempts > 0) and await is_prepared_message_fresh(session, action)
+        if prepared:
+            message = action.prepared_message
+        else:
+            message = await generate_action_message(session, bot, llm, user, action)
 
-        user_summary = get_user_summary(user)
-
-        # try:
-        llm_response = await llm.get_response(context_messages,  
-                                              summary=user_summary,           
-                                              user_language=user.language, 
-                                                tools=get_llm_functions(),
-                                                call_tool=build_call_tool_function(bot, session, llm, user, user.language))
-        message = llm_response.content
-        # except Exception as e:
-        #     logger.error("Failed to generate message with LLM", action_id=action.id, error=str(e))
-        #     message = f"Reminder: {action.description}"  # Fallback to the description
-
-        await send_message_to_user(bot, user.telegram_id, message, llm=llm, user_language=user.language)
-        logger.info("Triggered scheduled action", action_id=action.id, user_id=action.user_id)
+        await verify_claim(session, [action])
+        # The LLM already answers in the user's language, the generated text is not a translatable template
+        try:
+            await outbox.submit(user.telegram_id, lambda: bot.send_message(chat_id=user.telegram_id, text=message), PRIORITY_SCHEDULED)
+        except Exception as e:
+            raise ActionSendError(message) from e
+        action.prepared_message = None
+        action.prepared_at = None
+        logger.info("Triggered scheduled action", action_id=action.id, user_id=action.user_id, prepared=prepared)
     else:
         logger.warning("User not found for scheduled action", action_id=action.id, user_id=action.user_id)
+
+async def send_digest(session: AsyncSession, bot: Bot, llm: LLMWrapper, user: User, actions: list[ScheduledAction]):
+    """Send one message covering several overdue actions of a user.
+
+    Commits the session before the LLM call, the caller must not have pending changes."""
+    budget = llm.context_budget(DIGEST_INSTRUCTIONS)
+    action_message = {"role": "user", "content": "Missed actions:\n" + "\n".join(
+        f"- {action.description} (was due at {action.trigger_time.isoformat()} UTC)" for action in actions
+    )}
+    budget.reserve(action_message["content"])
+    user_summary = budget.fit_summary(get_user_summary(user))
+    await session.commit()  # Return the connection to the pool while the message is generated
+
+    llm_response = await llm.get_response([action_message],
+                                          summary=user_summary,
+                                          user_language=user.language,
+                                          instructions=DIGEST_INSTRUCTIONS,
+                                          raise_errors=True)
+    await verify_claim(session, actions)
+    await outbox.submit(user.telegram_id, lambda: bot.send_message(chat_id=user.telegram_id, text=llm_response.content), PRIORITY_SCHEDULED)
+    logger.info("Sent digest of overdue actions", user_id=user.telegram_id, action_ids=[action.id for action in actions])
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 import os
+import socket
 
 class Settings(BaseSettings):
     # Configuration for environment file and extra settings
@@ -14,6 +15,11 @@ class Settings(BaseSettings):
     POSTGRES_DB: str = Field("thirdwheeler", env="POSTGRES_DB")
     POSTGRES_HOST: str = Field("localhost", env="POSTGRES_HOST")
     POSTGRES_PORT: str = Field("5432", env="POSTGRES_PORT")
+    # Connection pool of the async engine
+    db_pool_size: int = Field(10, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(10, env="DB_MAX_OVERFLOW")  # Extra connections opened under load, closed when returned
+    db_pool_timeout: float = Field(10, env="DB_POOL_TIMEOUT")  # Max seconds to wait for a free connection
+    db_pool_recycle: int = Field(1800, env="DB_POOL_RECYCLE")  # Connections older than this are replaced
 
     # Logging settings
     loglevel: str = Field("DEBUG", env="LOGLEVEL")
@@ -24,6 +30,91 @@ class Settings(BaseSettings):
     llm_model: str = Field(default="gpt-4o-mini", env="LLM_MODEL")
     use_openai_llm: bool = Field(True, env="USE_OPENAI_LLM")
     openai_api_key: str = Field(None, env="OPENAI_API_KEY")
+    llm_timeout: float = Field(60, env="LLM_TIMEOUT")
+    llm_pool_size: int = Field(20, env="LLM_POOL_SIZE")  # Max pooled HTTP connections to the LLM backend
+    llm_keepalive_expiry: float = Field(30, env="LLM_KEEPALIVE_EXPIRY")
+    llm_tool_concurrency: int = Field(4, env="LLM_TOOL_CONCURRENCY")  # Tool calls of one turn executed in parallel
+    llm_max_tool_rounds: int = Field(3, env="LLM_MAX_TOOL_ROUNDS")  # tool -> model -> tool rounds before a final answer is forced
+
+    # LLM admission control: global concurrency limit and max queueing time per lane before a request is shed
+    llm_max_concurrency: int = Field(4, env="LLM_MAX_CONCURRENCY")
+    llm_deadline_interactive: float = Field(30, env="LLM_DEADLINE_INTERACTIVE")
+    llm_deadline_translation: float = Field(30, env="LLM_DEADLINE_TRANSLATION")
+    llm_deadline_scheduled: float = Field(300, env="LLM_DEADLINE_SCHEDULED")
+
+    # Prompt token budgets per model, the completion reserve is kept free for the answer
+    llm_context_limits: dict[str, int] = Field({"gpt-4o-mini": 16000, "gpt-4o": 16000, "llama3.1": 8192}, env="LLM_CONTEXT_LIMITS")
+    llm_context_limit_default: int = Field(8192, env="LLM_CONTEXT_LIMIT_DEFAULT")
+    llm_completion_reserve: int = Field(1024, env="LLM_COMPLETION_RESERVE")
+    context_summary_share: float = Field(0.25, env="CONTEXT_SUMMARY_SHARE")  # Max share of the budget for the user summary
+    context_actions_share: float = Field(0.25, env="CONTEXT_ACTIONS_SHARE")  # Max share of the budget for the scheduled actions
+    context_archive_share: float = Field(0.1, env="CONTEXT_ARCHIVE_SHARE")  # Max share of the budget for the archived conversations
+
+    # Scheduler: full reload of the schedule even without change notifications, in seconds
+    scheduler_reconcile_interval: float = Field(300, env="SCHEDULER_RECONCILE_INTERVAL")
+    scheduler_workers: int = Field(8, env="SCHEDULER_WORKERS")  # Due actions triggered in parallel
+    scheduler_instance_id: str = Field(default_factory=lambda: f"{socket.gethostname()}-{os.getpid()}", env="SCHEDULER_INSTANCE_ID")
+    scheduler_lease_seconds: float = Field(600, env="SCHEDULER_LEASE_SECONDS")  # How long a claimed action is reserved for this instance
+    scheduler_lookahead_window: float = Field(900, env="SCHEDULER_LOOKAHEAD_WINDOW")  # Messages of recurring actions due within this many seconds are generated in advance
+    scheduler_lookahead_interval: float = Field(60, env="SCHEDULER_LOOKAHEAD_INTERVAL")
+    # Catch-up of overdue backlogs (e.g. after an outage)
+    scheduler_catchup_after: float = Field(600, env="SCHEDULER_CATCHUP_AFTER")  # Actions overdue by more seconds are drained by the catch-up pass
+    scheduler_catchup_stale_after: float = Field(24 * 3600, env="SCHEDULER_CATCHUP_STALE_AFTER")  # Actions overdue by more seconds are dropped
+    scheduler_catchup_page_size: int = Field(20, env="SCHEDULER_CATCHUP_PAGE_SIZE")  # Actions claimed at once, other instances can take the rest of the backlog
+    scheduler_catchup_send_interval: float = Field(0.5, env="SCHEDULER_CATCHUP_SEND_INTERVAL")  # Pause between catch-up messages
+
+    # Retries of failed actions: exponential backoff with jitter, dead-lettered after max attempts
+    scheduler_max_attempts: int = Field(5, env="SCHEDULER_MAX_ATTEMPTS")
+    scheduler_retry_base_delay: float = Field(60, env="SCHEDULER_RETRY_BASE_DELAY")  # Delay after the first failure, doubled after each further one
+    scheduler_retry_max_delay: float = Field(6 * 3600, env="SCHEDULER_RETRY_MAX_DELAY")
+
+    # Translation cache
+    translation_cache_size: int = Field(5000, env="TRANSLATION_CACHE_SIZE")
+    translation_cache_ttl: float = Field(24 * 3600, env="TRANSLATION_CACHE_TTL")
+    translation_negative_ttl: float = Field(300, env="TRANSLATION_NEGATIVE_TTL")  # How long a failed translation is not retried
+    translation_preload_limit: int = Field(2000, env="TRANSLATION_PRELOAD_LIMIT")
+
+    # Prebuilt translations of the system messages, see build_language_pack.py
+    language_pack_path: str = Field("language_pack.json", env="LANGUAGE_PACK_PATH")
+    language_pack_languages: list[str] = Field(["de", "es", "fr", "it", "nl", "pl", "pt", "ru", "tr", "uk"], env="LANGUAGE_PACK_LANGUAGES")
+    language_pack_batch_size: int = Field(10, env="LANGUAGE_PACK_BATCH_SIZE")
+
+    # Streaming replies: edit the placeholder at most every interval seconds and only after min chars of new text
+    stream_edit_interval: float = Field(1.0, env="STREAM_EDIT_INTERVAL")
+    stream_edit_min_chars: int = Field(20, env="STREAM_EDIT_MIN_CHARS")
+
+    # Rate limiting of user messages and commands, see rate_limit.py
+    rate_limit_backend: str = Field("memory", env="RATE_LIMIT_BACKEND")  # "memory" per process or "postgres" shared by all processes
+    rate_limit_rate: float = Field(1 / 3, env="RATE_LIMIT_RATE")  # Tokens refilled per second
+    rate_limit_burst: float = Field(3, env="RATE_LIMIT_BURST")  # Tokens a user can spend at once
+    rate_limit_costs: dict[str, float] = Field({"message": 1, "command": 1, "add_partner": 2, "delete_all_my_data": 2}, env="RATE_LIMIT_COSTS")  # Per command name, "command" for the others
+    rate_limit_audit: bool = Field(False, env="RATE_LIMIT_AUDIT")  # Write every message and command to user_action_logs
+
+    # Conversations and action logs are inserted in bulk in the background, see write_behind.py
+    write_behind_batch_size: int = Field(200, env="WRITE_BEHIND_BATCH_SIZE")  # Rows that trigger a flush right away
+    write_behind_flush_interval: float = Field(0.5, env="WRITE_BEHIND_FLUSH_INTERVAL")  # Max seconds a row waits
+    write_behind_max_pending: int = Field(10000, env="WRITE_BEHIND_MAX_PENDING")  # Rows buffered before writers have to wait
+    write_behind_max_retries: int = Field(60, env="WRITE_BEHIND_MAX_RETRIES")  # Failed flushes in a row before the waiting rows are dropped
+
+    # Monthly partitions of conversations, user_action_logs and translations, see retention.py
+    # action: "drop", "detach" (kept as a standalone table) or "compact" (conversations only, into conversation_archives)
+    retention_policies: dict[str, dict] = Field({
+        "conversations": {"action": "compact", "keep_months": 6},
+        "user_action_logs": {"action": "drop", "keep_months": 3},
+        "translations": {"action": "drop", "keep_months": 12},  # A cache, dropped texts are translated again when needed
+    }, env="RETENTION_POLICIES")
+    retention_months_ahead: int = Field(3, env="RETENTION_MONTHS_AHEAD")  # Partitions created ahead of time
+    retention_interval: float = Field(24 * 3600, env="RETENTION_INTERVAL")  # Seconds between runs in the bot, 0 to only run retention.py
+    retention_lock_timeout: str = Field("5s", env="RETENTION_LOCK_TIMEOUT")  # Partition DDL gives up instead of blocking writers for long
+    retention_archive_messages: int = Field(50, env="RETENTION_ARCHIVE_MESSAGES")  # Most recent messages kept per user and month
+    retention_archive_message_chars: int = Field(500, env="RETENTION_ARCHIVE_MESSAGE_CHARS")
+
+    # Outgoing Telegram calls, see outbox.py
+    outbox_global_rate: float = Field(30, env="OUTBOX_GLOBAL_RATE")  # Messages per second across all chats
+    outbox_chat_rate: float = Field(1, env="OUTBOX_CHAT_RATE")  # Messages per second to one chat
+    outbox_chat_burst: float = Field(3, env="OUTBOX_CHAT_BURST")  # Messages to one chat sent without delay after a pause
+    outbox_max_retries: int = Field(3, env="OUTBOX_MAX_RETRIES")  # Retries of a call answered with 429
+    outbox_max_chats: int = Field(10000, env="OUTBOX_MAX_CHATS")  # Chat buckets kept before idle ones are dropped
 
 # Usage
 settings = Settings()
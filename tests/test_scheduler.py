@@ -0,0 +1,37 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+import httpx
+import openai
+import pytest
+from llm import LLMWrapper
+from models import ScheduledAction, User
+from scheduler import record_failure, trigger_action
+from settings import settings
+
+
+def failing_llm() -> LLMWrapper:
+    llm = LLMWrapper()
+    llm.client = MagicMock()
+    llm.client.chat.completions.create = AsyncMock(side_effect=openai.APIConnectionError(request=httpx.Request("POST", "http://llm/v1/chat/completions")))
+    return llm
+
+
+def test_llm_failure_is_retried():
+    user = User(telegram_id=1, name="Alice", language="en", summary=None)
+    action = ScheduledAction(id=10, user_id=1, description="Remind Alice to call Bob", attempts=0, is_active=True, claimed_by=settings.scheduler_instance_id)
+    session = AsyncMock()
+    session.scalar.return_value = user
+    session.scalars.return_value = MagicMock(all=lambda: [])
+    session.add = MagicMock()
+    bot = AsyncMock()
+
+    with pytest.raises(openai.APIError) as error:
+        asyncio.run(trigger_action(session, bot, failing_llm(), action))
+    bot.send_message.assert_not_called()
+
+    next_time = record_failure(session, action, error.value)
+    assert next_time is not None and next_time == action.next_attempt_at
+    assert action.attempts == 1
+    assert action.is_active
+    assert action.claimed_by is None
+    session.add.assert_not_called()  # Not dead-lettered
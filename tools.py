@@ -1,12 +1,14 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from db_utils import add_scheduled_action, delete_scheduled_action
+from db_utils import add_scheduled_action, delete_scheduled_action, get_async_session
 from models import Conversation, User, Translation
 from database import SessionLocal
-from utils import format_scheduled_actions, send_message_to_user
+from utils import format_scheduled_actions, next_occurrence, send_message_to_user
 from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from sqlalchemy import select
 from pydantic import BaseModel, Field
-from typing import ClassVar
+from typing import ClassVar, Optional
 import openai
 import structlog
 
@@ -49,10 +51,10 @@ class OverwriteSummary(BaseAction):
     @classmethod
     # @BaseAction.with_db_session
     async def execute(cls, bot, session, llm, user, user_language, arguments: dict):
-        user = session.query(User).filter(User.id == arguments['user_id']).first()
+        user = await session.scalar(select(User).where(User.id == arguments['user_id']))
         if user:
             user.summary = arguments['new_summary']
-            session.commit()
+            await session.commit()
             logger.info("User summary updated", user_id=user.id)
             return "Summary updated successfully"
         logger.error("User not found", user_id=arguments['user_id'])
@@ -60,19 +62,29 @@ class OverwriteSummary(BaseAction):
 
 class AddScheduledAction(BaseAction):
     """Schedule an action in the future. Use this tool whenever you plan to do something in the future. 
-    Make sure to add the description of the desired action frequency to the action description for future rescheduling since only one action is scheduled at a time and after triggering it, the next action is scheduled."""
+    For recurring actions set recurrence_rule, the action is then rescheduled automatically after each trigger and must not be scheduled again."""
     function_name: ClassVar[str] = "add_scheduled_action"
 
     user_id: int = Field(..., description="The ID of the user.")
-    description: str = Field(..., description="Description of the action, including recurrence.")
-    trigger_time: str = Field(..., description="The trigger time in ISO 8601 format.")
+    description: str = Field(..., description="Description of the action.")
+    trigger_time: str = Field(..., description="The (first) trigger time in ISO 8601 format. Without a UTC offset it is local time in the given timezone.")
+    recurrence_rule: Optional[str] = Field(None, description="For recurring actions an iCalendar RRULE, e.g. 'FREQ=WEEKLY;BYDAY=MO,TH' or 'FREQ=DAILY;INTERVAL=2;COUNT=10'. Null for one-time actions.")
+    timezone: Optional[str] = Field(None, description="IANA timezone of the user the recurrence is evaluated in, e.g. 'Europe/Berlin'. Null for UTC.")
 
     @classmethod
     # @BaseAction.with_db_session
     async def execute(cls, bot, session, llm, user, user_language, arguments: dict):
         trigger_time = datetime.fromisoformat(arguments['trigger_time'])
-        action_id = add_scheduled_action(session, user.telegram_id, arguments['description'], trigger_time)
-        await send_message_to_user(bot, user.telegram_id, f"Scheduled action {action_id} added!", llm, user_language)
+        recurrence_rule = arguments.get('recurrence_rule') or None
+        timezone_name = arguments.get('timezone') or None
+        if trigger_time.tzinfo is None:
+            trigger_time = trigger_time.replace(tzinfo=ZoneInfo(timezone_name) if timezone_name else timezone.utc)
+        trigger_time = trigger_time.astimezone(timezone.utc)
+        if recurrence_rule:
+            # Fails for invalid rules or timezones, the error is reported back to the LLM
+            next_occurrence(trigger_time, recurrence_rule, timezone_name, trigger_time)
+        action_id = await add_scheduled_action(session, user.telegram_id, arguments['description'], trigger_time, recurrence_rule, timezone_name)
+        await send_message_to_user(bot, user.telegram_id, "Scheduled action {action_id} added!", llm, user_language, action_id=action_id)
 
 class DeleteScheduledAction(BaseAction):
     """Delete an existing scheduled action."""
@@ -83,8 +95,8 @@ class DeleteScheduledAction(BaseAction):
     @classmethod
     # @BaseAction.with_db_session
     async def execute(cls, bot, session, llm, user, user_language, arguments: dict) -> str:
-        delete_scheduled_action(session, int(arguments['action_id']))
-        await send_message_to_user(bot, user.telegram_id, f"Scheduled action {arguments['action_id']} deleted!", llm, user_language)
+        await delete_scheduled_action(session, int(arguments['action_id']))
+        await send_message_to_user(bot, user.telegram_id, "Scheduled action {action_id} deleted!", llm, user_language, action_id=arguments['action_id'])
         return "tool call succesfully deleted scheduled action"
 
 # Function to retrieve LLM tools
@@ -103,14 +115,16 @@ def get_action_class_by_function_name(function_name: str):
     return None
 
 # Unified execution handler using dynamic class method calling
-async def execute_tool(bot, session, llm, user, user_language, function_name: str, arguments: dict) -> str:
+async def execute_tool(bot, llm, user, user_language, function_name: str, arguments: dict) -> str:
     """Handle execution of different tool functions by dynamically calling the respective class methods.
 
+        Each call gets its own session, tool calls of one turn run concurrently.
         returns a feedback string for the llm """
     try:
         action_class = get_action_class_by_function_name(function_name)
         if action_class:
-            await action_class.execute(bot, session, llm, user, user_language, arguments)
+            async with get_async_session() as session:
+                await action_class.execute(bot, session, llm, user, user_language, arguments)
             return f"successfully executed tool {function_name}"
         else:
             logger.warning(f"Unknown function call: {function_name}")
@@ -120,5 +134,5 @@ async def execute_tool(bot, session, llm, user, user_language, function_name: st
         return f"Error executing tool {function_name}: {e}"
 
 # Factory to build tool function handler
-def build_call_tool_function(bot, session, llm, user, user_language):
-    return lambda function_name, arguments: execute_tool(bot, session, llm, user, user_language, function_name, arguments)
+def build_call_tool_function(bot, llm, user, user_language):
+    return lambda function_name, arguments: execute_tool(bot, llm, user, user_language, function_name, arguments)
@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+import structlog
+from sqlalchemy import func, insert, select
+from database import AsyncSessionLocal
+from models import Translation
+from settings import settings
+
+logger = structlog.get_logger()
+
+# Marks a cached failure, the original text is used until it expires
+FAILED = object()
+
+def text_hash(text: str) -> str:
+    """md5 of a text as Postgres computes it, translations are indexed by the hash of their original text."""
+    return hashlib.md5(text.encode()).hexdigest()
+
+def load_language_pack(path: str) -> dict[str, dict[str, str]]:
+    """Load the prebuilt translations of the system messages (see build_language_pack.py)."""
+    if not os.path.exists(path):
+        logger.info("No language pack found", path=path)
+        return {}
+    with open(path, encoding="utf-8") as f:
+        languages = json.load(f)["languages"]
+    logger.info("Language pack loaded", path=path, languages=list(languages))
+    return languages
+
+class TranslationService:
+    """Translates system messages with a bounded in-memory cache in front of the translations table and the LLM.
+
+    - LRU cache bounded by size and TTL
+    - concurrent misses for the same (text, language) share a single lookup / LLM call
+    - failed translations are cached for a shorter time and fall back to the original text
+    - messages from the prebuilt language pack are served without any DB or LLM call"""
+
+    def __init__(self, llm, max_size: int = settings.translation_cache_size, ttl: float = settings.translation_cache_ttl, negative_ttl: float = settings.translation_negative_ttl):
+        self.llm = llm
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = OrderedDict()  # (text, language) -> (translated_text or FAILED, expires_at)
+        self._inflight = {}  # (text, language) -> Future of the translation in progress
+        self.language_pack = load_language_pack(settings.language_pack_path)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key, value, ttl: float):
+        self._cache[key] = (value, time.monotonic() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def preload(self, limit: int = settings.translation_preload_limit):
+        """Fill the cache with the most recently stored translations."""
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(Translation.original_text, Translation.target_language, Translation.translated_text)
+                .order_by(Translation.timestamp.desc())
+                .limit(limit)
+            )).all()
+        # Insert oldest first so the most recent rows end up as most recently used
+        for original_text, target_language, translated_text in reversed(rows):
+            self._put((original_text, target_language), translated_text, self.ttl)
+        logger.info("Translation cache preloaded", entries=len(rows))
+
+    async def translate(self, text: str, target_language: str) -> str:
+        if target_language == "en":
+            return text  # default strings are in English, no translation needed
+
+        packed = self.language_pack.get(target_language, {}).get(text)
+        if packed is not None:
+            self.hits += 1
+            return packed
+
+        key = (text, target_language)
+        cached = self._get(key)
+        if cached is not None:
+            self.hits += 1
+            return text if cached is FAILED else cached
+
+        # Another request is already translating this text, wait for its result
+        if key in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            try:
+                translated_text = await self._load(text, target_language)
+                self._put(key, translated_text, self.ttl)
+            except Exception as e:
+                logger.error("Translation failed", original_text=text, target_language=target_language, error=str(e))
+                self._put(key, FAILED, self.negative_ttl)
+                translated_text = text  # Fallback to the original text if translation fails
+            future.set_result(translated_text)
+        finally:
+            del self._inflight[key]
+            if not future.done():
+                future.cancel()
+        return translated_text
+
+    async def translate_many(self, texts: list[str], target_language: str) -> list[str]:
+        """Translate several texts to one language, all misses are translated with a single LLM call."""
+        if target_language == "en":
+            return list(texts)
+
+        results, waiting, misses = {}, {}, []
+        for text in dict.fromkeys(texts):
+            packed = self.language_pack.get(target_language, {}).get(text)
+            cached = packed if packed is not None else self._get((text, target_language))
+            if cached is not None:
+                self.hits += 1
+                results[text] = text if cached is FAILED else cached
+            elif (text, target_language) in self._inflight:
+                self.hits += 1
+                waiting[text] = self._inflight[(text, target_language)]
+            else:
+                self.misses += 1
+                misses.append(text)
+
+        if misses:
+            loop = asyncio.get_running_loop()
+            futures = {text: loop.create_future() for text in misses}
+            for text, future in futures.items():
+                self._inflight[(text, target_language)] = future
+            try:
+                try:
+                    translated = await self._load_many(misses, target_language)
+                    for text in misses:
+                        self._put((text, target_language), translated[text], self.ttl)
+                except Exception as e:
+                    logger.error("Batch translation failed", count=len(misses), target_language=target_language, error=str(e))
+                    for text in misses:
+                        self._put((text, target_language), FAILED, self.negative_ttl)
+                    translated = {text: text for text in misses}
+                for text, future in futures.items():
+                    future.set_result(translated[text])
+                results.update(translated)
+            finally:
+                for text, future in futures.items():
+                    del self._inflight[(text, target_language)]
+                    if not future.done():
+                        future.cancel()
+
+        for text, future in waiting.items():
+            results[text] = await asyncio.shield(future)
+        return [results[text] for text in texts]
+
+    async def translate_many_languages(self, texts: list[str], languages: list[str]) -> dict[str, list[str]]:
+        """Translate several texts to several languages, one batch per language in parallel."""
+        languages = list(dict.fromkeys(languages))
+        results = await asyncio.gather(*(self.translate_many(texts, language) for language in languages))
+        return dict(zip(languages, results))
+
+    async def _load_many(self, texts: list[str], target_language: str) -> dict[str, str]:
+        async with AsyncSessionLocal() as session:
+            translated = dict((await session.execute(
+                select(Translation.original_text, Translation.translated_text)
+                .where(
+                    Translation.target_language == target_language,
+                    func.md5(Translation.original_text).in_([text_hash(text) for text in texts]),
+                    Translation.original_text.in_(texts)
+                )
+            )).all())
+        missing = [text for text in texts if text not in translated]
+        if not missing:
+            return translated
+
+        if len(missing) == 1:
+            new_translations = [await self.llm.translate_with_llm(missing[0], target_language)]
+        else:
+            new_translations = await self.llm.translate_many_with_llm(missing, target_language)
+
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(Translation), [
+                {"original_text": text, "target_language": target_language, "translated_text": translated_text}
+                for text, translated_text in zip(missing, new_translations)
+            ])
+            await session.commit()
+        logger.info("Texts translated successfully", count=len(missing), target_language=target_language)
+
+        translated.update(zip(missing, new_translations))
+        return translated
+
+    async def _load(self, text: str, target_language: str) -> str:
+        async with AsyncSessionLocal() as session:
+            translated_text = await session.scalar(
+                select(Translation.translated_text)
+                .where(
+                    Translation.target_language == target_language,
+                    func.md5(Translation.original_text) == text_hash(text),
+                    Translation.original_text == text
+                )
+                .limit(1)
+            )
+        if translated_text is not None:
+            return translated_text
+
+        translated_text = await self.llm.translate_with_llm(text, target_language)
+
+        async with AsyncSessionLocal() as session:
+            session.add(Translation(original_text=text, target_language=target_language, translated_text=translated_text))
+            await session.commit()
+
+        # Log the successful translation
+        logger.info("Text translated successfully", original_text=text, translated_text=translated_text, target_language=target_language)
+        return translated_text
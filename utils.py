@@ -1,59 +1,149 @@
+import asyncio
+import math
 import structlog
-from sqlalchemy.orm import Session
+from string import Formatter
+from typing import AsyncIterator
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Message
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
-from models import ScheduledAction, User, UserActionLog
+from db_utils import UserContext
+from models import ScheduledAction, User
+from outbox import PRIORITY_INTERACTIVE, outbox
+from rate_limit import command_cost, rate_limiter
+import write_behind
 from datetime import datetime, timezone
+from dateutil.rrule import rrulestr
+from zoneinfo import ZoneInfo
+from settings import settings
 
 logger = structlog.get_logger()
 
-def get_translated_message(llm, text: str, target_language: str) -> str:
-    """Translate a system message to the user's language."""
-    return llm.translate(text, target_language)
+def template_fields(template: str) -> set[str]:
+    """Return the names of the {placeholders} in a message template."""
+    return {field for _, field, _, _ in Formatter().parse(template) if field is not None}
 
-async def send_message_to_user(bot, chat_id: int, message: str, llm, user_language: str):
-    """Send a translated message to a user."""
-    translated_message = get_translated_message(llm, message, user_language)
-    await bot.send_message(chat_id=chat_id, text=translated_message)
+async def get_translated_message(llm, text: str, target_language: str, **params) -> str:
+    """Translate a system message to the user's language.
 
-def update_user_language(session: Session, user: User, telegram_language: str) -> None:
-    """Update the user's language if it differs from the provided telegram language."""
+    Dynamic values are passed as params and filled into the {placeholders} of the
+    text after translation, so each template is only translated once per language."""
+    translated = await llm.translate(text, target_language)
+    return fill_template(text, translated, **params)
+
+def fill_template(template: str, translated: str, **params) -> str:
+    """Fill params into a translated template, falls back to the original template if the translation broke it."""
+    if not params:
+        return translated
+    try:
+        fields = template_fields(translated)
+    except ValueError:  # Unbalanced braces
+        fields = None
+    if fields != template_fields(template):
+        logger.warning("Translated template lost its placeholders", template=template, translated=translated)
+        translated = template
+    return translated.format(**params)
+
+async def send_message_to_user(bot, chat_id: int, message: str, llm, user_language: str, priority: int = PRIORITY_INTERACTIVE, **params):
+    """Send a translated message to a user, params are filled into the message template."""
+    translated_message = await get_translated_message(llm, message, user_language, **params)
+    await outbox.submit(chat_id, lambda: bot.send_message(chat_id=chat_id, text=translated_message), priority)
+
+async def reply_text(message: Message, text: str) -> Message:
+    """Reply to a message through the outbox."""
+    return await outbox.submit(message.chat_id, lambda: message.reply_text(text))
+
+async def stream_reply(message: Message, deltas: AsyncIterator[str]) -> str:
+    """Reply to a message with a placeholder and progressively edit it while the text is generated.
+
+    Edits are throttled to stay under Telegram's edit limits. Text beyond Telegram's
+    length limit continues in a new message. Returns the full text, the placeholder is
+    deleted if nothing was generated."""
+    loop = asyncio.get_running_loop()
+    reply = await reply_text(message, "…")
+    full_text, text, shown, last_edit = "", "", "", 0.0  # text: the part shown in the current reply
+
+    async def edit(new_text):
+        nonlocal shown, last_edit
+        try:
+            await outbox.submit(message.chat_id, lambda: reply.edit_text(new_text))
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        shown, last_edit = new_text, loop.time()
+
+    async for delta in deltas:
+        full_text += delta
+        text += delta
+        # Start a new message once the current one is full
+        while len(text) > MessageLimit.MAX_TEXT_LENGTH:
+            await edit(text[:MessageLimit.MAX_TEXT_LENGTH])
+            text = text[MessageLimit.MAX_TEXT_LENGTH:]
+            reply = await reply_text(message, text or "…")
+            shown = text
+        # Show the first tokens right away, then throttle
+        if not shown.strip() and text.strip() \
+                or (len(text) - len(shown) >= settings.stream_edit_min_chars
+                    and loop.time() - last_edit >= settings.stream_edit_interval):
+            await edit(text)
+
+    if not text.strip():
+        # Nothing (more) was generated, don't leave the placeholder behind
+        await outbox.submit(message.chat_id, lambda: reply.delete())
+    elif text != shown:
+        await edit(text)
+    return full_text
+
+async def update_user_language(session: AsyncSession, user: User | UserContext, telegram_language: str) -> None:
+    """Update the user's language if it differs from the provided telegram language.
+
+    Works with a UserContext snapshot as well, the change is committed with the session."""
     if user.language != telegram_language:
-        user.language = telegram_language
-        session.commit()
+        await session.execute(update(User).where(User.telegram_id == user.telegram_id).values(language=telegram_language))
         logger.info(f"Updated language for user {user.telegram_id} to {telegram_language}")
 
-async def rate_limited(update: ContextTypes.DEFAULT_TYPE, context: ContextTypes.DEFAULT_TYPE, session: Session, llm) -> bool:
+async def rate_limited(update: ContextTypes.DEFAULT_TYPE, context: ContextTypes.DEFAULT_TYPE, llm, user: UserContext | None) -> bool:
     """Check if the user is rate-limited and handle the response if they are."""
     user_telegram_id = update.effective_user.id
     user_language = update.message.from_user.language_code or 'en'
-    current_time = datetime.now(timezone.utc)
 
-    user = session.query(User).filter(User.telegram_id == user_telegram_id).first()
     if not user:
-        translated_message = get_translated_message(llm, "Please start the bot first using /start.", 'en')
-        await update.message.reply_text(translated_message)
+        translated_message = await get_translated_message(llm, "Please start the bot first using /start.", 'en')
+        await reply_text(update.message, translated_message)
         return True
 
-    last_action_time = session.query(UserActionLog.timestamp).filter(UserActionLog.user_id == user.telegram_id).order_by(UserActionLog.timestamp.desc()).first()
-
-    if last_action_time:
-        # Convert last_action_time to an offset-aware datetime if it's offset-naive
-        last_action_time_aware = last_action_time[0].replace(tzinfo=timezone.utc) if last_action_time[0].tzinfo is None else last_action_time[0]
-        
-        if (current_time - last_action_time_aware).total_seconds() < 3:
-            translated_message = get_translated_message(llm, "You're doing that too much. Please slow down.", user_language)
-            await update.message.reply_text(translated_message)
-            logger.info("Rate limit enforced", telegram_id=user_telegram_id)
-            return True
-    
-    log_entry = UserActionLog(user_id=user.telegram_id, action=update.message.text, timestamp=current_time)
-    session.add(log_entry)
-    session.commit()
-    
+    result = await rate_limiter.acquire(user.telegram_id, command_cost(update.message.text))
+    if not result.allowed:
+        translated_message = await get_translated_message(llm, "You're doing that too much. Please try again in {seconds} seconds.", user_language, seconds=math.ceil(result.retry_after))
+        await reply_text(update.message, translated_message)
+        logger.info("Rate limit enforced", telegram_id=user_telegram_id, retry_after=round(result.retry_after, 3))
+        return True
+
+    if settings.rate_limit_audit:
+        await write_behind.action_logs.add(user_id=user.telegram_id, action=update.message.text, timestamp=datetime.now(timezone.utc))
     return False
 
 from datetime import datetime, timezone
 
+def format_scheduled_action(action: ScheduledAction, current_time: datetime) -> str:
+    trigger_time = action.trigger_time if action.trigger_time.tzinfo else action.trigger_time.replace(tzinfo=timezone.utc)
+    time_until_trigger = trigger_time - current_time
+    days, seconds = time_until_trigger.days, time_until_trigger.seconds
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+
+    # Format the time until trigger in a human-readable way
+    time_str = f"{days} days, {hours} hours, and {minutes} minutes" if days > 0 else \
+               f"{hours} hours and {minutes} minutes" if hours > 0 else \
+               f"{minutes} minutes"
+
+    return (
+        f"- Action ID {action.id}: {action.description} "
+        f"(scheduled to trigger in {time_str}, at {action.trigger_time.isoformat()} UTC)\n"
+    )
+
 def format_scheduled_actions(actions : list[ScheduledAction]):
     if not actions:
         return "No scheduled actions."
@@ -62,19 +152,19 @@ def format_scheduled_actions(actions : list[ScheduledAction]):
     formatted_list = "Here are the scheduled actions:\n"
     
     for action in actions:
-        time_until_trigger = action.trigger_time - current_time
-        days, seconds = time_until_trigger.days, time_until_trigger.seconds
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-
-        # Format the time until trigger in a human-readable way
-        time_str = f"{days} days, {hours} hours, and {minutes} minutes" if days > 0 else \
-                   f"{hours} hours and {minutes} minutes" if hours > 0 else \
-                   f"{minutes} minutes"
-
-        formatted_list += (
-            f"- Action ID {action.id}: {action.description} "
-            f"(scheduled to trigger in {time_str}, at {action.trigger_time.isoformat()} UTC)\n"
-        )
+        formatted_list += format_scheduled_action(action, current_time)
     
     return formatted_list
+
+def next_occurrence(series_start: datetime, recurrence_rule: str, timezone_name: str | None, after: datetime) -> datetime | None:
+    """Return the first occurrence of a recurrence rule after the given time, in UTC.
+
+    The rule starts at series_start, the first occurrence of the series (not the current
+    one, or COUNT would never end it), and is evaluated in the action's timezone, so e.g.
+    BYHOUR=9 stays at 9:00 local time across DST changes. Returns None once the rule ends."""
+    tz = ZoneInfo(timezone_name) if timezone_name else timezone.utc
+    if series_start.tzinfo is None:
+        series_start = series_start.replace(tzinfo=timezone.utc)
+    rule = rrulestr(recurrence_rule, dtstart=series_start.astimezone(tz))
+    occurrence = rule.after(after.astimezone(tz))
+    return occurrence.astimezone(timezone.utc) if occurrence else None
@@ -0,0 +1,121 @@
+import asyncio
+import structlog
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from database import async_engine
+from models import Conversation, UserActionLog
+from settings import settings
+
+logger = structlog.get_logger()
+
+class WriteBehindBuffer:
+    """Collects rows of one table in memory and inserts them in bulk in the background.
+
+    A flush runs every flush_interval seconds or as soon as batch_size rows are waiting.
+    A batch rejected for its data (e.g. a foreign key to a deleted user) is split in halves
+    until the offending rows are found, those are logged and dropped, the rest is written.
+    Rows of a flush that failed otherwise (e.g. the database is unreachable) are put back and
+    retried, after max_retries failed flushes in a row they are dropped.
+    Memory is bounded: once max_pending rows are waiting, add() waits for a flush.
+    Rows are written later, so they should carry their own timestamp."""
+
+    def __init__(self, model, batch_size: int, flush_interval: float, max_pending: int, max_retries: int):
+        self.table = model.__table__
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._retries = 0
+        self._rows = []
+        self._lock = None
+        self._batch_ready = None
+        self._flusher = None
+        self._stopping = False
+        self.metrics = {"written": 0, "flushes": 0, "failed_flushes": 0, "dropped": 0, "max_pending": 0}
+
+    async def add(self, **row):
+        if self._flusher is None or self._flusher.done():
+            self._stopping = False
+            self._lock = asyncio.Lock()
+            self._batch_ready = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        while len(self._rows) >= self.max_pending:
+            logger.warning("Write-behind buffer full, waiting for a flush", table=self.table.name, pending=len(self._rows))
+            if not await self.flush():
+                await asyncio.sleep(self.flush_interval)
+        self._rows.append(row)
+        self.metrics["max_pending"] = max(self.metrics["max_pending"], len(self._rows))
+        if len(self._rows) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self) -> bool:
+        """Insert all waiting rows, returns False if they were put back after a failure."""
+        async with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return True
+            pending = [rows]  # Chunks still to be written, in order
+            try:
+                while pending:
+                    chunk = pending[0]
+                    try:
+                        async with async_engine.begin() as connection:
+                            await connection.execute(insert(self.table), chunk)
+                    except (IntegrityError, DataError) as e:
+                        pending.pop(0)
+                        if len(chunk) > 1:
+                            middle = len(chunk) // 2
+                            pending[:0] = [chunk[:middle], chunk[middle:]]
+                        else:
+                            self.metrics["dropped"] += 1
+                            logger.error("Write-behind row rejected, dropped", table=self.table.name, row=chunk[0], error=str(e))
+                        continue
+                    pending.pop(0)
+                    self.metrics["written"] += len(chunk)
+            except Exception as e:
+                remaining = [row for chunk in pending for row in chunk]
+                self.metrics["failed_flushes"] += 1
+                self._retries += 1
+                if self._retries > self.max_retries:
+                    self._retries = 0
+                    self.metrics["dropped"] += len(remaining)
+                    logger.error("Write-behind flush failed too often, rows dropped", table=self.table.name, rows=len(remaining), error=str(e))
+                    return True
+                self._rows[:0] = remaining  # Retried with the next flush, ahead of newer rows
+                logger.error("Write-behind flush failed", table=self.table.name, rows=len(remaining), retries=self._retries, error=str(e))
+                return False
+            except BaseException:
+                self._rows[:0] = [row for chunk in pending for row in chunk]  # Cancelled, the rows stay buffered for close()
+                raise
+            self._retries = 0
+            self.metrics["flushes"] += 1
+            return True
+
+    async def _flush_periodically(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+    async def close(self, attempts: int = 3):
+        """Stop the background flushes and write the remaining rows."""
+        if self._flusher is None:
+            return
+        # Let a flush in progress finish instead of cancelling it halfway
+        self._stopping = True
+        self._batch_ready.set()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        for _ in range(attempts):
+            if await self.flush():
+                return
+            await asyncio.sleep(self.flush_interval)
+        logger.error("Write-behind rows lost on shutdown", table=self.table.name, rows=len(self._rows))
+
+conversations = WriteBehindBuffer(Conversation, settings.write_behind_batch_size, settings.write_behind_flush_interval, settings.write_behind_max_pending, settings.write_behind_max_retries)
+action_logs = WriteBehindBuffer(UserActionLog, settings.write_behind_batch_size, settings.write_behind_flush_interval, settings.write_behind_max_pending, settings.write_behind_max_retries)
+
+async def close():
+    await asyncio.gather(conversations.close(), action_logs.close())